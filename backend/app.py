@@ -1,37 +1,335 @@
 #Holds the backend code that will run the stock data, live tracking, 
 #graphing plotting/tracking etc
-from flask import Flask, request, jsonify 
+from flask import Flask, Response, request, jsonify 
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from datetime import datetime, timedelta
-import yfinance as yStock
+import atexit
+import csv
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
+from quote_cache import QuoteCache
+from providers import create_provider, upstreamCalls, upstreamPool
+from price_store import PriceStore, OPEN_DAY_TTL
+from symbol_reference import SymbolReference
+from transaction_store import TransactionStore, OversoldError
+from cost_basis import COST_BASIS_METHODS
+from transaction_log import TransactionLog
+from live_prices import LivePricePoller
+from downsampling import downsampling_series, RESOLUTIONS
+from risk_metrics import calculating_risk
+from fx_rates import DEFAULT_CURRENCY, MissingRateError, reading_currency, conversion_plan, plan_symbols
+from metrics import requestMetrics, metric_family, server_timing
 
 #This is to allow for the code to also run the front end section of it
 app = Flask(__name__)
 CORS(app)
 
+#Every jsonify goes through here, so the time spent turning the results into JSON
+#shows up as its own stage of the request
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        with requestMetrics.span('serialization'):
+            return super().dumps(obj, **kwargs)
+
+app.json = TimedJSONProvider(app)
+
 #This will act as the temp memory that stores the users input data to track
-userPortfolios = {}
-userTransactions = []
+userPortfolios = {} #portfolio_id -> its settings (e.g. the base currency)
+portfolioSettingsLock = threading.Lock()
+userTransactions = TransactionStore() #Transactions indexed by portfolio (and ticker within it)
+
+#Everything the users add is also written to disk here so it survives a restart,
+#setting TRANSACTION_LOG_DIR to an empty value keeps it all in memory only
+transactionLogDirectory = os.environ.get('TRANSACTION_LOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'transactions'))
+transactionLog = None
+savedDataOpened = False
+savedDataError = None #Why the saved data couldn't be opened the last time it was tried
+savedDataLock = threading.Lock()
+
+#Loads the latest snapshot and replays the log written after it, then has every new
+#transaction written to the log. Only runs once, in the process that serves requests.
+#If it fails nothing is kept (so a retry starts clean) and the next request tries again
+def opening_saved_data():
+    global transactionLog, savedDataOpened, savedDataError
+    with savedDataLock:
+        if savedDataOpened:
+            return
+        if not transactionLogDirectory:
+            savedDataOpened = True
+            return
+
+        log = TransactionLog(transactionLogDirectory)
+        try:
+            state, records = log.recover()
+        except Exception as error:
+            savedDataError = str(error)
+            raise
+        try:
+            if state is not None:
+                userTransactions.load_state(state['transactions'])
+                userPortfolios.update(state['portfolios'])
+            for kind, data in records:
+                if kind == 'transaction':
+                    userTransactions.replay(data)
+                elif kind == 'portfolio':
+                    userPortfolios[data['portfolio_id']] = data['settings']
+        except Exception as error:
+            userTransactions.clear()
+            userPortfolios.clear()
+            log.close()
+            savedDataError = str(error)
+            raise
+
+        transactionLog = log
+        userTransactions.log = log
+        log.start(capturing_snapshot)
+        atexit.register(log.close)
+        savedDataOpened = True
+        savedDataError = None
+
+#Grabs the whole state and starts a new log generation at the exact same point,
+#so the snapshot covers every log up to (and including) the one that was closed
+def capturing_snapshot():
+    transactions_state, generation = userTransactions.dump_state(while_locked=transactionLog.rotate)
+    return {'transactions': transactions_state, 'portfolios': dict(userPortfolios)}, generation
+
+#Where all the market data comes from (yfinance by default, or local fixtures)
+marketData = create_provider()
+
+#Every lookup of a stocks .info goes through this cache so the same ticker
+#only gets fetched once no matter how many routes ask for it
+quoteCache = QuoteCache(lambda symbol: marketData.get_info(symbol),
+                        lambda symbols: marketData.get_batch_quotes(symbols),
+                        pool=upstreamPool)
+
+#The daily closes are saved on disk as they get downloaded, so the history for a
+#range only ever has to be fetched once
+priceStore = PriceStore(os.environ.get('PRICE_STORE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'prices.sqlite3')),
+                        lambda symbol, start, end: marketData.get_history(symbol, start, end))
+
+#The name, sector, industry, currency and market cap of every symbol are kept in a
+#local table on disk that refreshes itself in the background, so the allocation and
+#stock info don't need a round trip to Yahoo for fields that barely ever change.
+#Every symbol held in a portfolio is kept in it, anything else is added when first asked for
+symbolReference = SymbolReference(os.environ.get('SYMBOL_REFERENCE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'symbols.sqlite3')),
+                                  lambda symbol: quoteCache.get_info(symbol),
+                                  pool=upstreamPool,
+                                  symbols_source=lambda: [ticker for portfolio_id in userTransactions.portfolio_ids() for ticker in userTransactions.tickers(portfolio_id)])
+
+#One poller fetches the prices of every symbol that is being streamed, no matter how
+#many clients are watching it, and the fresh prices land in the quote cache for everyone
+livePrices = LivePricePoller(lambda symbols: quoteCache.get_prices(symbols, max_age=0))
+
+#Allows swapping the market data source (e.g. to the offline fixtures) while running,
+#the caches are cleared so nothing from the old source leaks through
+def set_market_data_provider(provider):
+    global marketData
+    marketData = provider
+    quoteCache.clear()
+    priceStore.clear()
+    symbolReference.clear()
+
+#Bulk imports are checked this many rows at a time, and only the first few
+#hundred bad rows get described in the response
+BULK_BATCH_SIZE = 1000
+BULK_MAX_REPORTED_ERRORS = 500
+
+#Setting SERVER_TIMING=1 hands the time each stage of a request took back to the
+#client in the Server-Timing header (it shows up in the browser's network tab)
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+
+#Every request is timed from start to finish and split into stages, these hooks are
+#registered first so the timing wraps everything the other hooks do too
+@app.before_request
+def start_request_timing():
+    requestMetrics.start_request()
+
+@app.after_request
+def finish_request_timing(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    timings = requestMetrics.finish_request(route, request.method, response.status_code)
+    if SERVER_TIMING and timings:
+        response.headers['Server-Timing'] = server_timing(timings)
+    return response
+
+@app.teardown_request
+def end_request_timing(error=None):
+    requestMetrics.end_request()
+
+#Every request gets its own count of how many upstream calls it had to make,
+#which is handed back in the X-Upstream-Calls header
+@app.before_request
+def start_upstream_count():
+    upstreamCalls.start_request()
+
+    #Without the saved data every answer would be wrong and new trades would be lost on
+    #the next restart, so only the health and metrics are served until it can be opened
+    try:
+        opening_saved_data()
+    except Exception as error:
+        if request.endpoint not in ('health_check', 'getting_metrics'):
+            return jsonify({'error': 'Saved data could not be opened: %s' % error}), 503
+
+@app.after_request
+def report_upstream_count(response):
+    response.headers['X-Upstream-Calls'] = str(upstreamCalls.request_count())
+    return response
+
+#JSON bigger than this gets gzipped for clients that accept it (a few years of daily
+#performance points shrink to around a fifth)
+GZIP_MIN_SIZE = 1024
+
+@app.after_request
+def compressing_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings or response.content_length < GZIP_MIN_SIZE:
+        return response
 
-#Need to verify that the health of the API is well
+    with requestMetrics.span('compression'):
+        response.set_data(gzip.compress(response.get_data(), compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    #The compressed body is a different set of bytes, so it gets its own strong ETag
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag + '-gzip')
+    return response
+
+#The market data source is checked with one real quote at most this often, so polling the
+#health doesn't turn into a stream of upstream calls, and gets this long to answer
+HEALTH_PROBE_TTL = 30
+HEALTH_PROBE_TIMEOUT = 3
+healthProbe = {'checked_at': 0, 'result': None}
+healthProbeLock = threading.Lock()
+
+def checking_market_data():
+    with healthProbeLock:
+        if healthProbe['result'] is not None and time.time() - healthProbe['checked_at'] < HEALTH_PROBE_TTL:
+            return healthProbe['result']
+        started = time.perf_counter()
+        try:
+            quotes = upstreamPool.call(marketData.get_batch_quotes, [DEFAULT_BENCHMARK], timeout=HEALTH_PROBE_TIMEOUT)
+            result = {'status': 'ok' if quotes.get(DEFAULT_BENCHMARK) else 'degraded'}
+            if result['status'] != 'ok':
+                result['error'] = 'No quote for %s' % DEFAULT_BENCHMARK
+        except Exception as error:
+            result = {'status': 'down', 'error': str(error)}
+        result['provider'] = marketData.name
+        result['latency_ms'] = (time.perf_counter() - started) * 1000
+        healthProbe['checked_at'] = time.time()
+        healthProbe['result'] = result
+        return result
+
+#Runs a check and hands back {'status': 'ok'} or the error it hit
+def checking_dependency(check):
+    try:
+        check()
+        return {'status': 'ok'}
+    except Exception as error:
+        return {'status': 'down', 'error': str(error)}
+
+def checking_transaction_log():
+    if not transactionLogDirectory:
+        return {'status': 'disabled'}
+    if transactionLog is None:
+        return {'status': 'down', 'error': 'The transaction log could not be opened: %s' % (savedDataError or 'not tried yet')}
+    if not os.access(transactionLogDirectory, os.W_OK):
+        return {'status': 'down', 'error': 'The transaction log directory is not writable'}
+    result = {'status': 'ok'}
+    result.update(transactionLog.stats())
+    if result['error'] is not None:
+        result['status'] = 'down' #A write or sync failed, so nothing new can be saved
+    return result
+
+#Need to verify that the health of the API is well, the storage being down makes the
+#service unhealthy (503) while the market data being down only degrades it since
+#everything already saved can still be served
 @app.route('/api/health', methods = ['GET'])
 def health_check():
     try:
+        dependencies = {
+            "priceStore": checking_dependency(priceStore.ping),
+            "symbolReference": checking_dependency(symbolReference.ping),
+            "transactionLog": checking_transaction_log(),
+            "marketData": checking_market_data()
+        }
+        storage = [dependencies[name]['status'] for name in ('priceStore', 'symbolReference', 'transactionLog')]
+        if 'down' in storage:
+            status = "unhealthy"
+        elif dependencies['marketData']['status'] != 'ok':
+            status = "degraded"
+        else:
+            status = "healthy"
+
         response = {
-            "status": "healthy",
-            "service": "functional",
-            "upTime": "GOOD"
+            "status": status,
+            "service": "functional" if status != "unhealthy" else "Non-functional",
+            "upTime": requestMetrics.uptime(),
+            "startedAt": datetime.fromtimestamp(requestMetrics.started_at).isoformat(),
+            "dependencies": dependencies,
+            "quoteCache": quoteCache.stats(),
+            "symbolReference": symbolReference.stats(),
+            "upstreamCalls": dict(upstreamCalls.totals),
+            "liveStream": livePrices.stats()
         }
-        return jsonify(response), 200
+        return jsonify(response), 200 if status != "unhealthy" else 503
     except Exception as error:
         response = {
-            "status": "Unhealthy",
+            "status": "unhealthy",
             "service": "Non-functional",
-            "upTime": "TERRIBLE",
-            "error": error
+            "upTime": requestMetrics.uptime(),
+            "error": str(error)
         }
-        return jsonify(response), 400
+        return jsonify(response), 503
+
+#Everything the service counts, in the Prometheus text format so it can be scraped.
+#The numbers are per process, with more than one worker each one is its own target
+@app.route('/metrics', methods = ['GET'])
+def getting_metrics():
+    lines = requestMetrics.render()
+
+    upstream_totals = sorted(dict(upstreamCalls.totals).items())
+    lines += metric_family('upstream_calls_total', 'counter', 'Calls made to the market data source',
+                           [((kind,), count) for kind, count in upstream_totals], ('kind',))
+    lines += metric_family('upstream_timeouts_total', 'counter', 'Upstream calls given up on after the timeout', [((), upstreamPool.timeouts)])
+    lines += metric_family('upstream_failures_total', 'counter', 'Upstream calls that raised', [((), upstreamPool.failures)])
+
+    #The hits and misses of both caches as one family each, told apart by the cache label
+    caches = (('quote', quoteCache.stats()), ('symbol_reference', symbolReference.stats()))
+    lines += metric_family('cache_hits_total', 'counter', 'Lookups answered from the cache',
+                           [((name,), stats['hits']) for name, stats in caches], ('cache',))
+    lines += metric_family('cache_misses_total', 'counter', 'Lookups that had to go upstream',
+                           [((name,), stats['misses']) for name, stats in caches], ('cache',))
+    lines += metric_family('cache_hit_ratio', 'gauge', 'Share of lookups answered from the cache',
+                           [((name,), stats['hit_ratio']) for name, stats in caches], ('cache',))
+    lines += metric_family('cache_entries', 'gauge', 'Entries held in the cache',
+                           [(('quote',), caches[0][1]['size']), (('symbol_reference',), caches[1][1]['symbols'])], ('cache',))
+    with riskResultsLock:
+        lines += metric_family('risk_results_cached', 'gauge', 'Risk results kept for reuse', [((), len(riskResults))])
+
+    live = livePrices.stats()
+    lines += metric_family('live_stream_subscribers', 'gauge', 'Clients watching a live portfolio stream', [((), live['subscribers'])])
+    lines += metric_family('live_stream_symbols', 'gauge', 'Symbols being polled for the live streams', [((), live['symbols'])])
+
+    if transactionLog is not None:
+        log = transactionLog.stats()
+        lines += metric_family('transaction_log_fsyncs_total', 'counter', 'Times the transaction log was synced to disk', [((), log['fsyncs'])])
+        lines += metric_family('transaction_log_snapshots_total', 'counter', 'Snapshots taken of the transactions', [((), log['snapshots_taken'])])
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
 
 #This method is responsible for getting the stock information 
 #via the yFinance and add to the sturcture array of the user
@@ -43,34 +341,29 @@ def proper_stock_info(ticker):
     #will try and retrieve that stock info
     
     try:
-        find_stock = yStock.Ticker(ticker)
-        stock_info = find_stock.info #Grabs relavent info about the stock
-
-        #Need to get multiple field references to display
-        stock_price = (stock_info.get('currentPrice') or 
-                      stock_info.get('regularMarketPrice') or 
-                      stock_info.get('previousClose') or 
-                      stock_info.get('ask') or 
-                      stock_info.get('bid') or 0)
-
-        #Need to check that the stock isnt empty and has a current price ready
-        stock_price = stock_info.get('currentPrice') or stock_info.get('regularMarketPrice', 0)
+        #The name, sector etc come from the local reference table (only a symbol we have
+        #never seen goes upstream for them) and the price from the quote cache
+        with requestMetrics.span('fetch'):
+            stock_info = upstreamPool.call(symbolReference.get, ticker) #Grabs relavent info about the stock
+
+            #Need to check that the stock was found and has a current price ready
+            if stock_info is None:
+                return None
+            stock_price = upstreamPool.call(quoteCache.get_prices, [ticker])[ticker.upper()]
         if stock_price == 0:
             return None
         
-        #Make sure stock is relevant enough to find all the info on
-        if (len(stock_info) > 5):
-            #Then add it to the dictionary which gets the tags to it
-            stock_data = {
-                'symbol': stock_info.get('symbol', ticker.upper()),
-                'longName': stock_info.get('longName', 'unknown'),
-                'currentPrice': stock_price,
-                'marketCap': stock_info.get('marketCap', 0),
-                'sector': stock_info.get('sector', 'Unknown'), 
-                'industry': stock_info.get('industry', 'Unknown'),
-                'currency': stock_info.get('currency', 'USD')
-            }
-            return stock_data
+        #Then add it to the dictionary which gets the tags to it
+        stock_data = {
+            'symbol': stock_info['symbol'],
+            'longName': stock_info.get('longName', 'unknown'),
+            'currentPrice': stock_price,
+            'marketCap': stock_info.get('marketCap', 0),
+            'sector': stock_info.get('sector', 'Unknown'), 
+            'industry': stock_info.get('industry', 'Unknown'),
+            'currency': stock_info.get('currency', 'USD')
+        }
+        return stock_data
     except Exception as e:
         return {'error': str(e), 'ticker': ticker} #means the stock couldn't be located
 
@@ -101,6 +394,67 @@ def display_stock_info(ticker):
     except Exception as e:
      return jsonify({'error': str(e), 'ticker': ticker}), 500 #means the stock couldn't be located
 
+#Checks one transaction sent in by the user and turns it into the dictionary we store,
+#handing back (transaction, None) when it is good or (None, error response) when it isn't.
+#Both the single and the bulk transaction routes go through here so the rules are the same
+def validating_transaction(portfolio_id, stock_data):
+
+    #Then we need to check to make sure that the 
+    #json data of the stocks matches the parameters
+    error_response = {
+        "data": 'untrackable',
+        "error": 'missing key stock information or error in stock formatting'
+    }
+
+    if not isinstance(stock_data, dict):
+        return None, error_response
+
+    #All the different conditions to check
+    for key in ('ticker', 'shares', 'purchase_date', 'purchase_price'):
+        if key not in stock_data:
+            return None, error_response
+
+    #The ticker has to be an actual symbol (a JSON null would otherwise be saved as 'NONE')
+    ticker = stock_data.get('ticker')
+    if not isinstance(ticker, str) or not ticker.strip():
+        return None, {"error": "Stock ticker has to be a symbol"}
+
+    try:
+        #Now that the boundaries are checked we need to vaildate the data types and values 
+        #(nan and inf get through float() so they are turned away here too)
+        shares = float(stock_data.get('shares'))
+        if not math.isfinite(shares) or shares <= 0:
+            return None, {"error": "Stock Shares need to be positive"}
+    
+        prices = float(stock_data.get('purchase_price'))
+        if not math.isfinite(prices) or prices <= 0:
+            return None, {"error": "Stock Prices need to be positive"}
+
+        #The date has to be a real day since the holdings are tracked per day
+        datetime.strptime(stock_data.get('purchase_date'), '%Y-%m-%d')
+
+        #Trades are buys unless they say otherwise, a sell uses the same fields
+        #(the date and price it was sold at) and is checked against the holdings when saved
+        side = str(stock_data.get('side') or 'buy').strip().lower()
+        if side not in ('buy', 'sell'):
+            return None, {"error": "Stock side has to be buy or sell"}
+
+    except (ValueError, TypeError) as a:
+        return None, {'Invaild data type due to error': str(a)}
+        
+    #Aftewards we can add to a transcation dictionary that will then be 
+    #added to the userTransactions store (which hands out the id)
+    total_transactions = {
+        'portfolio_id': portfolio_id,
+        'ticker': ticker.strip().upper(), #Gets the stock information itself(name)
+        'shares': shares, 
+        'purchase_date': stock_data.get('purchase_date'),
+        'purchase_price': prices, 
+        'side': side,
+        'time_stamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    return total_transactions, None
+
 #Next we need to add a method that allows the users to create a portfoilio structure of all 
 #stocks that they are currently tracking
 @app.route('/api/portfolio/<portfolio_id>/transaction', methods=['POST'])
@@ -109,66 +463,124 @@ def adding_transactions(portfolio_id):
         #We got get the data from a JSON request first
         stock_data = request.json
 
-        #Then we need to check to make sure that the 
-        #json data of the stocks matches the parameters
-        error_response = {
-            "data": 'untrackable',
-            "error": 'missing key stock information or error in stock formatting'
-        }
-
-        #All the different conditions to check
-        if 'ticker' not in stock_data:
-            return jsonify(error_response), 400
-    
-        if 'shares' not in stock_data:
+        total_transactions, error_response = validating_transaction(portfolio_id, stock_data)
+        if error_response is not None:
             return jsonify(error_response), 400
-    
-        if 'purchase_date' not in stock_data:
-            return jsonify(error_response), 400
-    
-        if 'purchase_price' not in stock_data:
-            return jsonify(error_response), 400
-    
-        #Now that the boundaries are checked we need to vaildate the data types and values 
-        shares = float(stock_data.get('shares'))
-        if (shares <= 0):
-            return jsonify({"Stock Shares need to be positive"}), 400
-    
-        prices = float(stock_data.get('purchase_price'))
-        if (prices <= 0):
-            return jsonify({"Stock Prices need to be positive"}), 400
-        
-        #Aftewards we can add to a transcation dictionary that will then be 
-        #appended to the userTransactions list 
-        total_transactions = {
-            'portfolio_id': portfolio_id,
-            'id': len(portfolio_id) + 1, 
-            'ticker': stock_data.get('ticker').upper(), #Gets the stock information itself(name)
-            'shares': shares, 
-            'purchase_date': stock_data.get('purchase_date', "Unknown"),
-            'purchase_price': prices, 
-            'time_stamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }   
-        #Then we append that data to the userTransactions list
+
+        #Then we add that data to the userTransactions store
         #and return the success
-        userTransactions.append(total_transactions)
-        return jsonify({"message": "Transactions have been updated"}), 201
+        userTransactions.add(portfolio_id, total_transactions)
+        return jsonify({"message": "Transactions have been updated", "id": total_transactions['id']}), 201
     
-    #Catching the two exceptions that could occur
+    #Catching the exceptions that could occur
+    except OversoldError as oversold:
+        return jsonify({"error": str(oversold)}), 400
+
     except ValueError as a:
          return jsonify({'Invaild data type due to error': str(a) }), 400
     
     except Exception as e:
         return jsonify({'Couldnt add to userTransactions due to error': str(e)}), 500
 
+#Reads the rows of a bulk upload one line at a time straight off the request stream,
+#so even a huge brokerage export is never held in memory as one big string. Excel and a
+#lot of brokerages start the file with a byte order mark, utf-8-sig drops it so the
+#first header is still just ticker
+def reading_bulk_rows(stream, content_type):
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+    if 'csv' in content_type:
+        for row in csv.DictReader(lines):
+            #Cells past the header end up under None and short rows fill in None,
+            #dropping both means a short row gets reported as missing information
+            yield {key: value for key, value in row.items() if key is not None and value is not None}
+        return
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as error:
+            yield error #Handed on so the row gets reported instead of stopping the import
+
+#Lets the user load a whole history of trades in one request instead of one POST per trade.
+#The body is CSV (with a ticker,shares,purchase_date,purchase_price[,side] header) or one JSON
+#object per line (NDJSON). Rows are checked in batches with the same rules as the single
+#route and every good row is saved in one write at the end
+@app.route('/api/portfolio/<portfolio_id>/transactions/import', methods=['POST'])
+def importing_transactions(portfolio_id):
+    content_type = (request.content_type or '').lower()
+    if 'csv' not in content_type and 'json' not in content_type:
+        return jsonify({'error': 'Bulk imports need a text/csv or application/x-ndjson body'}), 415
+
+    try:
+        accepted = []
+        accepted_rows = {} #id(transaction) -> row number, to report the sells the store turns down
+        errors = []
+        rejected = 0
+        batch = []
+
+        def checking_batch():
+            nonlocal rejected
+            for row_number, stock_data in batch:
+                if isinstance(stock_data, Exception):
+                    total_transactions, error_response = None, {'Invaild data type due to error': str(stock_data)}
+                else:
+                    total_transactions, error_response = validating_transaction(portfolio_id, stock_data)
+
+                if error_response is None:
+                    accepted.append(total_transactions)
+                    accepted_rows[id(total_transactions)] = row_number
+                else:
+                    rejected += 1
+                    if len(errors) < BULK_MAX_REPORTED_ERRORS:
+                        errors.append({'row': row_number, 'error': error_response})
+            batch.clear()
+
+        for row_number, stock_data in enumerate(reading_bulk_rows(request.stream, content_type), start=1):
+            batch.append((row_number, stock_data))
+            if len(batch) >= BULK_BATCH_SIZE:
+                checking_batch()
+        checking_batch()
+
+        #Everything that passed goes into the store (and the log) in one write, apart from
+        #sells of more shares than are held by then
+        added, oversold = userTransactions.add_many(portfolio_id, accepted)
+        for transaction, reason in oversold:
+            rejected += 1
+            if len(errors) < BULK_MAX_REPORTED_ERRORS:
+                errors.append({'row': accepted_rows[id(transaction)], 'error': {'error': reason}})
+        errors.sort(key=lambda error: error['row'])
+        accepted = added
+
+        response = {
+            'portfolio_id': portfolio_id,
+            'accepted': len(accepted),
+            'rejected': rejected,
+            'errors': errors,
+            'errors_truncated': rejected > len(errors)
+        }
+        if len(accepted) == 0 and rejected > 0:
+            return jsonify(response), 400
+        return jsonify(response), 201
+
+    except Exception as e:
+        return jsonify({'Couldnt add to userTransactions due to error': str(e)}), 500
+
 #This method gets the added transactions to return the filtered list of the data
 @app.route('/api/portfolio/<portfolio_id>/transactions', methods=['GET'])
 def getting_transactions(portfolio_id):
 
-    #Need to filter the userTransactions data via its portfolio_id tags
-    #we do this by using list comprehension
+    #The userTransactions store already keeps them grouped by their portfolio_id (and by
+    #ticker within it, so ?ticker=AAPL only ever looks at the trades of that ticker)
     try:
-        portfolio_transactions = [transaction for transaction in userTransactions if transaction['portfolio_id'] == portfolio_id]
+        ticker = request.args.get('ticker')
+        if ticker:
+            portfolio_transactions = userTransactions.for_ticker(portfolio_id, ticker)
+        else:
+            portfolio_transactions = userTransactions.for_portfolio(portfolio_id)
         #Then we can return the filitered list into a json format now 
         view_transactions = {
             "transactions": portfolio_transactions,
@@ -180,98 +592,193 @@ def getting_transactions(portfolio_id):
     except Exception as noT:
         return jsonify({'Couldnt extract transaction information due to error': str(noT)}), 500
 
+#The settings a portfolio starts out with until the user changes them
+DEFAULT_PORTFOLIO_SETTINGS = {'base_currency': DEFAULT_CURRENCY, 'cost_basis': 'fifo'}
+
+def portfolio_settings(portfolio_id):
+    settings = dict(DEFAULT_PORTFOLIO_SETTINGS)
+    settings.update(userPortfolios.get(portfolio_id, {}))
+    return settings
+
+#Saves the settings and writes them to the log like a transaction, so they come back
+#after a restart (and are part of every snapshot through userPortfolios)
+def saving_portfolio_settings(portfolio_id, settings):
+    seq = None
+    with portfolioSettingsLock:
+        userPortfolios[portfolio_id] = settings
+        if transactionLog is not None:
+            seq = transactionLog.append([['portfolio', {'portfolio_id': portfolio_id, 'settings': settings}]])
+    if seq is not None:
+        transactionLog.wait(seq)
+
+#The currency the values get reported in, a ?currency= query wins over the portfolio's
+#own setting. Hands back (currency, error message or None)
+def reading_base_currency(portfolio_id):
+    currency = request.args.get('currency') or portfolio_settings(portfolio_id)['base_currency']
+    base_currency = reading_currency(currency)
+    if base_currency is None:
+        return None, 'currency has to be a three letter currency code, e.g. USD'
+    return base_currency, None
+
+#The holdings of the portfolio with the cost basis worked out the way its settings say
+def reading_holdings(portfolio_id):
+    return userTransactions.holdings(portfolio_id, portfolio_settings(portfolio_id)['cost_basis'])
+
+#The currency each ticker is quoted in, out of the local reference table. A ticker that
+#couldn't be looked up is None rather than assumed to be in dollars, so it is treated like
+#a missing exchange rate (fill=False only reads what the table already has)
+def ticker_currencies(tickers, fill=True):
+    records = symbolReference.get_many(tickers, fill=fill)
+    return {ticker: records.get(ticker.upper(), {}).get('currency') for ticker in tickers}
+
+#Lets the user see and change the settings of their portfolio, e.g. PUT {"base_currency": "GBP"}
+#has every value of the portfolio reported in pounds from then on
+@app.route('/api/portfolio/<portfolio_id>/settings', methods=['GET', 'PUT'])
+def updating_portfolio_settings(portfolio_id):
+    try:
+        if request.method == 'GET':
+            return jsonify({'portfolio_id': portfolio_id, 'settings': portfolio_settings(portfolio_id)}), 200
+
+        changes = request.get_json(silent=True)
+        if not isinstance(changes, dict):
+            return jsonify({'error': 'Settings have to be sent as a JSON object'}), 400
+        unknown = [key for key in changes if key not in DEFAULT_PORTFOLIO_SETTINGS]
+        if unknown:
+            return jsonify({'error': 'Unknown settings: ' + ', '.join(unknown),
+                            'settings': list(DEFAULT_PORTFOLIO_SETTINGS)}), 400
+
+        settings = portfolio_settings(portfolio_id)
+        if 'base_currency' in changes:
+            base_currency = reading_currency(changes['base_currency'])
+            if base_currency is None:
+                return jsonify({'error': 'base_currency has to be a three letter currency code, e.g. USD'}), 400
+            settings['base_currency'] = base_currency
+        if 'cost_basis' in changes:
+            if changes['cost_basis'] not in COST_BASIS_METHODS:
+                return jsonify({'error': 'cost_basis has to be one of ' + ', '.join(COST_BASIS_METHODS)}), 400
+            settings['cost_basis'] = changes['cost_basis']
+
+        saving_portfolio_settings(portfolio_id, settings)
+        return jsonify({'portfolio_id': portfolio_id, 'settings': settings}), 200
+
+    except Exception as noSettings:
+        return jsonify({'Couldnt update the portfolio settings due to error': str(noSettings)}), 500
+
 #Want to calculate the value of all the stocks in the portfolio value
 #via all the transactions
-def calculating_portfolio_value(total_transactions):
-
-    #We need to first sort all the transactions via the ticker amount 
-    #by sorting through the all the holdings within the transactions list
-    total_holdings = {}
-
-    for transaction in total_transactions:
-        #Then we need to accumlate the same shares and costs respectively 
-        #into each of the stocks
-        named_stocks = transaction['ticker']
-
-        if named_stocks not in total_holdings:
-            total_holdings[named_stocks] = {'shares': 0, 'total_cost': 0}
-            #Then we increment the proper amount tied to ticker name, calculate
-            #the average cost of the share and total costs
-        total_holdings[named_stocks]['shares'] += transaction['shares']
-        total_holdings[named_stocks]['total_cost'] += transaction['shares'] * transaction['purchase_price']
-    
+def calculating_portfolio_value(total_holdings, base_currency=DEFAULT_CURRENCY):
+
+    #The shares and costs per ticker are already added up by the userTransactions
+    #store as each trade comes in, so all that is left is joining them with the prices
     #Then once that is all accumlated we need to create a dictionary that can store all the metric data 
     #we do this by storing the position of the data itself
     position_data = []
     total_value = 0
     total_cost = 0
+    realized_gain = 0
+
+    #All the current prices are grabbed together in one batch rather than
+    #making a round trip for each ticker, along with the exchange rate of every
+    #currency that isn't the base one
+    #Tickers that have been sold off only add the gain their sells realized
+    open_tickers = [ticker for ticker, data in total_holdings.items() if data['shares'] > 0]
+    with requestMetrics.span('fetch'):
+        currencies = ticker_currencies(list(total_holdings))
+        plan = conversion_plan(currencies, base_currency)
+        current_prices = quoteCache.get_prices(open_tickers + plan_symbols(plan))
 
     #Fetching the current price of this ticker, and calculating the metrics for this position
-    #that we can add to the list 
+    #that we can add to the list. A ticker whose exchange rate (or currency) couldn't be found
+    #is still listed (in its own currency) but flagged and left out of the totals
+    unconverted = []
     for ticker, data in total_holdings.items():
-        #Extracting the data 
-        shares = data['shares']
-        costs = data['total_cost']
-
-        #Find the current price from earlier example format
-        try:
-            locate_stock = yStock.Ticker(ticker)
-            stock_info = locate_stock.info.get('currentPrice') or locate_stock.info.get('regularMarketPrice', 0)
-
-            #Again trying to get multiple sources for the data
-            locate_price = (stock_info.get('currentPrice') or 
-                       stock_info.get('regularMarketPrice') or 
-                       stock_info.get('previousClose') or 
-                       stock_info.get('ask') or 
-                       stock_info.get('bid') or 0)
-
-            if locate_price == 0:
-                locate_price = 0
-            
-        except Exception as e:
-            locate_price = 0
-        
-        #Now we got use the formuala to calculate the rest of the information
-        if shares > 0:
-            avg_cost = costs / shares
+        rate_symbol, factor = plan[ticker]
+        if factor is None:
+            rate, factor = None, 1.0
         else:
-            avg_cost = 0
-
-        current_value = shares * locate_price
-        #Make sure we also find the absolute gain/loss of each of the stocks 
-
-        gain_loss = current_value - costs
-        if costs > 0:
-            gain_loss_percent = (gain_loss / costs) * 100
-        else:
-            gain_loss_percent = 0
-
-        #Now we can build a dictionary to store the positions which we 
-        #can then loop through and check to see how much the stock weights
-        #in its factor
-        calculated_stock_positions = {
-            'ticker': ticker, 
-            'shares': shares,
-            'avg_cost': avg_cost,
-            'cost_amount': costs, 
-            'current_price': locate_price, 
-            'current_value': current_value, 
-            'gain_loss': gain_loss, 
-            'gain_loss_percent': gain_loss_percent,
-            'weight': 0 #This is what we calculate to loop through
-        }
+            rate = current_prices.get(rate_symbol) if rate_symbol is not None else 1
+        if not rate:
+            unconverted.append(ticker)
+        if data['shares'] <= 0:
+            if rate:
+                realized_gain += data.get('realized_gain', 0) * factor * rate
+            continue
+        if not rate:
+            calculated_stock_positions = calculating_position(ticker, data, current_prices.get(ticker, 0), factor)
+            calculated_stock_positions.update({'currency': currencies[ticker], 'fx_rate': None, 'unconverted': True, 'weight': None})
+            position_data.append(calculated_stock_positions)
+            continue
+        calculated_stock_positions = calculating_position(ticker, data, current_prices.get(ticker, 0), factor * rate)
+        calculated_stock_positions['currency'] = currencies[ticker]
         position_data.append(calculated_stock_positions)
+        realized_gain += calculated_stock_positions['realized_gain']
         #Updates the storage amount and values of the data
-        total_value += current_value
-        total_cost += costs
+        total_value += calculated_stock_positions['current_value']
+        total_cost += calculated_stock_positions['cost_amount']
 
     #Then we do the final loop through to check and add the proper weight value
     for position in position_data:
+        if position.get('unconverted'):
+            continue
         if total_value > 0:
             position['weight'] = (position['current_value'] / total_value) * 100
         else:
             position['weight'] = 0
     
+    #Finally returning the full summary of it all
+    summary = calculating_portfolio_totals(total_value, total_cost, realized_gain)
+    summary['currency'] = base_currency
+    summary['unconverted'] = unconverted #Tickers the totals are missing, as they had no exchange rate
+    summary['num_positions'] = len(position_data)
+    summary['positions'] = position_data
+    return summary
+
+#Works out the metrics of one position from its holdings and current price, this is
+#also used on its own by the live stream to redo only the positions whose price moved.
+#The price and cost are in the currency the ticker is quoted in, fx_rate turns them into
+#the base currency (the cost is converted at today's rate too)
+def calculating_position(ticker, data, locate_price, fx_rate=1.0):
+    #Extracting the data 
+    shares = data['shares']
+    costs = data['total_cost'] * fx_rate
+    locate_price = locate_price * fx_rate
+    
+    #Now we got use the formuala to calculate the rest of the information
+    if shares > 0:
+        avg_cost = costs / shares
+    else:
+        avg_cost = 0
+
+    current_value = shares * locate_price
+    #Make sure we also find the absolute gain/loss of each of the stocks 
+
+    gain_loss = current_value - costs #Unrealized, what selling everything now would add
+    if costs > 0:
+        gain_loss_percent = (gain_loss / costs) * 100
+    else:
+        gain_loss_percent = 0
+
+    #Now we can build a dictionary to store the positions which we 
+    #can then loop through and check to see how much the stock weights
+    #in its factor
+    calculated_stock_positions = {
+        'ticker': ticker, 
+        'shares': shares,
+        'avg_cost': avg_cost,
+        'cost_amount': costs, 
+        'current_price': locate_price, 
+        'current_value': current_value, 
+        'gain_loss': gain_loss, 
+        'gain_loss_percent': gain_loss_percent,
+        'realized_gain': data.get('realized_gain', 0) * fx_rate, #Locked in by earlier sells
+        'fx_rate': fx_rate,
+        'weight': 0 #This is what we calculate to loop through
+    }
+    return calculated_stock_positions
+
+#The metrics of the whole portfolio from its total value and cost (of the shares still
+#held), the total return is what is unrealized and the gain of the sells is reported next to it
+def calculating_portfolio_totals(total_value, total_cost, realized_gain=0):
     #Update the portfilo metrics again
     total_returns = total_value - total_cost
     total_returns_percent = 0
@@ -281,29 +788,32 @@ def calculating_portfolio_value(total_transactions):
     else:
         total_returns_percent
     
-    #Finally returning the full summary of it all
     return {
         'total_value': total_value,
         'total_cost': total_cost,
         'total_return': total_returns,
         'total_return_percent': total_returns_percent,
-        'num_positions': len(position_data),
-        'positions': position_data
+        'unrealized_gain': total_returns,
+        'realized_gain': realized_gain
     }
 
 #Creating the function that get that calculation as a summary to display 
 @app.route('/api/portfolio/<portfolio_id>/summary', methods=['GET'])
 def get_portfolio_summary(portfolio_id):
 
+    base_currency, error = reading_base_currency(portfolio_id)
+    if error is not None:
+        return jsonify({'error': error}), 400
+
     #First we want to filter the transactions based on the users portfolio id
     #same idea as before
     try:
-        portfolio_calculations = [transaction for transaction in userTransactions if transaction['portfolio_id'] == portfolio_id]
+        portfolio_holdings = reading_holdings(portfolio_id)
         #Then check that any of them are empty
-        if len(portfolio_calculations) == 0:
+        if len(portfolio_holdings) == 0:
             return jsonify({'Result': "No summary created as data couldn't be located", }), 200
         
-        summary = calculating_portfolio_value(portfolio_calculations)
+        summary = calculating_portfolio_value(portfolio_holdings, base_currency)
         return jsonify(summary), 200
     
     #Catching the last place as always
@@ -313,82 +823,147 @@ def get_portfolio_summary(portfolio_id):
 #Calculating the performance of the portfolio now, but for the daily measurements
 #meaning that we need to deal with the real time data series of the stock data rather than all
 #all the collective data
-def calculating_real_time_portfolio_data(transactions_lists, start_date, end_date):
+def calculating_real_time_portfolio_data(cumulative_holdings, start_date, end_date, resolution='daily', max_points=None, base_currency=DEFAULT_CURRENCY):
     
+    #Rather than walking every day and rescanning the transactions we build two
+    #matrices (days x tickers), one for the shares held and one for the close price,
+    #and the value of each day is just the row sum of the two multiplied together
+    data_range, stock_tickers, shares_matrix, price_matrix, _ = building_valuation_matrices(cumulative_holdings, start_date, end_date, base_currency)
+    values = np.einsum('ij,ij->i', shares_matrix, price_matrix)
+    dates = data_range.strftime('%Y-%m-%d').tolist()
+
+    #Long ranges can be cut down to weekly/monthly points or a fixed number of points
+    if resolution != 'daily' or max_points is not None:
+        dates, values = downsampling_series(dates, values, resolution, max_points)
+        return {'dates': dates, 'values': values}
+
+    return {
+        'dates': dates,
+        'values': values.tolist()
+    }
+
+#Builds the shares held and the close price (in the base currency) of every ticker on
+#every day of the range, both days x tickers. This is shared by the performance and risk
+#routes, extra_symbols (e.g. a benchmark) are fetched in the same go and their history is
+#in the price data handed back with the matrices
+def building_valuation_matrices(cumulative_holdings, start_date, end_date, base_currency=DEFAULT_CURRENCY, extra_symbols=()):
+
     #Set our data range and stock tickers
     data_range = pd.date_range(start=start_date, end=end_date, freq='D') #For daily occurance tracking
-    stock_tickers = set([t['ticker'] for t in transactions_lists]) #Creates the unique range of symbols for the transactions
+    stock_tickers = sorted(cumulative_holdings.columns) #The unique range of symbols in the portfolio
 
-    #Once we have all that data we then need to fetch all the prices within the date range
-    price_data = {}
-    for ticker in stock_tickers:
-        stocks = yStock.Ticker(ticker)
-        stock_range = stocks.history(start=start_date, end=end_date)
+    #Once we have all that data we then need to fetch all the prices within the date range,
+    #the price store only goes upstream for the days it hasn't saved yet. The daily exchange
+    #rates of any currency that isn't the base one are just more symbols in the same store
+    with requestMetrics.span('fetch'):
+        plan = conversion_plan(ticker_currencies(stock_tickers), base_currency)
+        rate_symbols = plan_symbols(plan)
+        price_data = priceStore.get_histories(stock_tickers + rate_symbols + list(extra_symbols), start_date, end_date, pool=upstreamPool)
 
-        #One last check to make sure
-        if not stock_range.empty:
-            stock_range.index = stock_range.index.tz_localize(None)
+    shares_matrix = building_shares_matrix(cumulative_holdings, data_range, stock_tickers)
 
-        #Adding to the dictionary for the range
-        price_data[ticker] = stock_range
-    
-    #Then for each date we got to calculate the value
-    dates_list = []
-    values_list = []
+    #A ticker held in the range whose currency isn't known can't be valued at all, one that
+    #isn't held just has nothing to convert
+    unknown = [column for column, ticker in enumerate(stock_tickers) if plan[ticker][1] is None]
+    held = [stock_tickers[column] for column in unknown if shares_matrix[:, column].any()]
+    if held:
+        raise MissingRateError(['%s (unknown currency)' % ticker for ticker in held])
+    for column in unknown:
+        plan[stock_tickers[column]] = (None, 1.0)
 
-    #We do that through the filtering of the transactions up to the dates, etc
-    for current_date in data_range: 
+    price_matrix = building_price_matrix(price_data, data_range, stock_tickers)
+    if rate_symbols or any(factor != 1 for _, factor in plan.values()):
+        conversion_matrix = building_conversion_matrix(price_data, data_range, stock_tickers, plan, rate_symbols)
+        #A day the shares are held but there is no rate yet would be valued at 0
+        missing = ((conversion_matrix == 0) & (shares_matrix != 0)).any(axis=0)
+        if missing.any():
+            raise MissingRateError(set(plan[ticker][0] for ticker, is_missing in zip(stock_tickers, missing) if is_missing))
+        price_matrix = price_matrix * conversion_matrix
+    return data_range, stock_tickers, shares_matrix, price_matrix, price_data
 
-        transaction_range = [t for t in transactions_lists 
-            if datetime.strptime(t['purchase_date'], '%Y-%m-%d') <= current_date
-        ]
+#Spreads the holdings log (shares held after each trade date) over every day of the range,
+#anything bought before the range is already held on the first day
+def building_shares_matrix(cumulative_holdings, data_range, stock_tickers):
+    daily_shares = cumulative_holdings.reindex(columns=stock_tickers).reindex(data_range, method='ffill')
+    return daily_shares.fillna(0).to_numpy()
 
-        #Once we have the proper range we can then sort by the ticker like in calculating 
-        #portfolio method 
-        daily_holdings = {}
-        for holdings in transaction_range:
-            tickers = holdings['ticker']
+#Lines up the close prices of every ticker with the range, days without a
+#price (weekends, holidays) carry the last known close forward
+def building_price_matrix(price_data, data_range, stock_tickers):
+    price_matrix = np.zeros((len(data_range), len(stock_tickers)))
+    days = data_range.values.astype('datetime64[ns]')
+    for column, ticker in enumerate(stock_tickers):
+        stock_range = price_data.get(ticker)
+        if stock_range is None or stock_range.empty:
+            continue #No price at all means the position adds nothing
 
-            if tickers not in daily_holdings:
-                daily_holdings[tickers] = {'shares': 0, 'total_cost': 0}
-            
-            daily_holdings[tickers]['shares'] += holdings['shares']
-            daily_holdings[tickers]['total_cost'] += holdings['shares'] * holdings['purchase_price']
-
-        #Then we can calculate the total value of the stocks across that range
-        total_value_of_stocks = 0
-        for ticker, data in daily_holdings.items():
-            #We do that by finding the date tied to it
-            data_shares = data['shares']
-            try:
-                #Convert current_date to just the date part for lookup
-                date_key = current_date.date()
-
-                #Then we see if it falls within the range and formats the data contained
-                #from the start to that end portion
-                if date_key in price_data[ticker].index.date:
-
-                    price = price_data[ticker].loc[current_date]['Close']
-                    total_value_of_stocks += data_shares * price
-                else:
-                    available_dates = price_data[ticker].index[price_data[ticker].index <= current_date]
+        close = stock_range['Close']
+        if not close.index.is_unique:
+            close = close[~close.index.duplicated(keep='last')]
+        if not close.index.is_monotonic_increasing:
+            close = close.sort_index()
 
-                    if len(available_dates) > 0:
-                        last_date = available_dates[-1]
-                        price = price_data[ticker].loc[last_date]['Close']
-                        total_value_of_stocks += data_shares * price
+        #The last close on or before each day (-1 while there isn't one yet)
+        positions = np.searchsorted(close.index.values.astype('datetime64[ns]'), days, side='right') - 1
+        values = close.to_numpy(dtype='float64')[np.maximum(positions, 0)]
+        price_matrix[:, column] = np.where(positions >= 0, values, 0)
+    return np.nan_to_num(price_matrix)
 
-            except Exception as e:
-                pass #We just need to skip in this case
+#Reads the resolution and max_points queries the performance series can be shrunk with,
+#handing back (resolution, max_points, error message or None)
+def reading_downsampling_args():
+    resolution = request.args.get('resolution', 'daily')
+    if resolution not in RESOLUTIONS:
+        return None, None, 'resolution has to be one of ' + ', '.join(RESOLUTIONS)
 
-        #Then we store the data values to return
-        dates_list.append(current_date.strftime('%Y-%m-%d'))
-        values_list.append(total_value_of_stocks)
+    max_points = request.args.get('max_points')
+    if max_points is not None:
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            return None, None, 'max_points has to be a whole number'
+        if max_points < 2:
+            return None, None, 'max_points has to be at least 2'
+    return resolution, max_points, None
 
-    return {
-        'dates': dates_list,
-        'values': values_list
-    }
+#Anything worked out from the holdings and the price history (the performance series, the
+#risk numbers) only changes when the portfolio gets a new trade or the price store saves
+#new closes, so those two versions plus the queries make up its tag (used as the ETag and
+#the cache key). A range that runs up to today also changes as today's price moves, so the
+#tag rolls over every OPEN_DAY_TTL seconds (the same as the price store refetches today).
+#The price store version starts over at 0 in every process, so the tag also carries one
+#random value per process to keep a restart from handing out an old tag for new data.
+#Tickers whose currency isn't known yet are in it too, so the tag changes once it is
+processTag = os.urandom(8).hex()
+
+def portfolio_data_tag(portfolio_id, start_date, end_date, *params):
+    currencies = ticker_currencies(userTransactions.tickers(portfolio_id), fill=False)
+    parts = [processTag, portfolio_id, userTransactions.version(portfolio_id), priceStore.version,
+             start_date, end_date, sorted(ticker for ticker, currency in currencies.items() if currency is None)] + list(params)
+    if end_date >= datetime.now().strftime('%Y-%m-%d'):
+        parts.append(int(time.time() // OPEN_DAY_TTL))
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:32]
+
+#The rate that turns each ticker's price into the base currency on every day of the range
+#(days x tickers). The rate series are lined up like the closes, then every ticker just
+#picks its currency's column (or a column of ones) and multiplies in the minor unit factor
+def building_conversion_matrix(price_data, data_range, stock_tickers, plan, rate_symbols):
+    rates = np.hstack([np.ones((len(data_range), 1)), building_price_matrix(price_data, data_range, rate_symbols)])
+    rate_columns = {symbol: column + 1 for column, symbol in enumerate(rate_symbols)}
+    columns = [rate_columns.get(plan[ticker][0], 0) for ticker in stock_tickers]
+    factors = np.array([plan[ticker][1] for ticker in stock_tickers], dtype=float)
+    return rates[:, columns] * factors
+
+#The 304 response when the client already has what the tag stands for (in either its
+#plain or gzipped form), otherwise None
+def not_modified(etag):
+    for tag in (etag, etag + '-gzip'):
+        if request.if_none_match.contains(tag):
+            response = Response(status=304)
+            response.set_etag(tag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+    return None
 
 #The method to run the app for getting the date ranges
 @app.route('/api/portfolio/<portfolio_id>/performance', methods=['GET'])
@@ -397,29 +972,137 @@ def getting_real_time_portfolio_data(portfolio_id):
     #Need to get the queries for the ranges(the start and end dates)
     end_date = request.args.get('end_date', datetime.now().strftime('%Y-%m-%d'))
     start_date = request.args.get('start_date', (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d'))
+    resolution, max_points, error = reading_downsampling_args()
+    if error is None:
+        base_currency, error = reading_base_currency(portfolio_id)
+    if error is not None:
+        return jsonify({'error': error}), 400
+
+    #Nothing has changed since the client last asked, so there is nothing to work out
+    etag = portfolio_data_tag(portfolio_id, start_date, end_date, 'performance', resolution, max_points, base_currency)
+    unchanged = not_modified(etag)
+    if unchanged is not None:
+        return unchanged
 
     try:
-        date_range_portfolio = [transaction for transaction in userTransactions if transaction['portfolio_id'] == portfolio_id]
+        cumulative_holdings = userTransactions.cumulative_holdings(portfolio_id)
         #Then check that any of them are empty
-        if len(date_range_portfolio) == 0:
+        if cumulative_holdings.empty:
             return jsonify({'Result': "No summary created as data couldn't be located", }), 200
         
-        summary = calculating_real_time_portfolio_data(date_range_portfolio, start_date, end_date)
-        return jsonify(summary), 200
+        summary = calculating_real_time_portfolio_data(cumulative_holdings, start_date, end_date, resolution, max_points, base_currency)
+
+        #The prices may have just been filled in, so the tag is taken again to match what was sent
+        response = jsonify(summary)
+        response.set_etag(portfolio_data_tag(portfolio_id, start_date, end_date, 'performance', resolution, max_points, base_currency))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response, 200
+
+    except MissingRateError as noRate:
+        return jsonify({'error': str(noRate), 'missing_rates': noRate.symbols}), 503
     
     #Catching the last place as always
     except Exception as noSummary:
         return jsonify({'Couldnt extract transaction information due to error': str(noSummary)}), 500
     
+#The risk numbers are kept for the last few tags asked for (the tag already changes with
+#the portfolio version, the saved prices and the range), compared with the benchmark
+#unless another ticker is asked for
+RISK_CACHE_SIZE = 64
+DEFAULT_BENCHMARK = 'SPY'
+riskResults = OrderedDict()
+riskResultsLock = threading.Lock()
+
+#Works out the risk of the portfolio over the range from the same matrices as the
+#performance, only on weekdays so weekends don't count as days where nothing moved
+def calculating_portfolio_risk(cumulative_holdings, start_date, end_date, benchmark=DEFAULT_BENCHMARK, risk_free=0.0, base_currency=DEFAULT_CURRENCY):
+    extra_symbols = [benchmark] if benchmark else []
+    data_range, stock_tickers, shares_matrix, price_matrix, price_data = building_valuation_matrices(
+        cumulative_holdings, start_date, end_date, base_currency, extra_symbols)
+
+    trading_days = np.asarray(data_range.dayofweek < 5)
+    dates = data_range[trading_days].strftime('%Y-%m-%d').tolist()
+    benchmark_prices = None
+    if benchmark:
+        benchmark_prices = building_price_matrix(price_data, data_range, [benchmark])[trading_days, 0]
+
+    risk = calculating_risk(dates, stock_tickers, shares_matrix[trading_days], price_matrix[trading_days],
+                            benchmark_prices, risk_free)
+    risk.update({'start_date': start_date, 'end_date': end_date, 'benchmark': benchmark,
+                 'risk_free': risk_free, 'currency': base_currency})
+    return risk
+
+#Volatility, max drawdown, Sharpe ratio, beta against the benchmark (?benchmark=, SPY by
+#default), how much each position adds to the risk and the covariance of the tickers
+@app.route('/api/portfolio/<portfolio_id>/risk', methods=['GET'])
+def getting_portfolio_risk(portfolio_id):
+
+    end_date = request.args.get('end_date', datetime.now().strftime('%Y-%m-%d'))
+    start_date = request.args.get('start_date', (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d'))
+    benchmark = request.args.get('benchmark', DEFAULT_BENCHMARK).strip().upper()
+    try:
+        risk_free = float(request.args.get('risk_free', 0))
+    except ValueError:
+        risk_free = None
+    if risk_free is None or not math.isfinite(risk_free): #float() also takes nan and inf
+        return jsonify({'error': 'risk_free has to be a yearly rate, e.g. 0.04'}), 400
+    base_currency, error = reading_base_currency(portfolio_id)
+    if error is not None:
+        return jsonify({'error': error}), 400
+
+    etag = portfolio_data_tag(portfolio_id, start_date, end_date, 'risk', benchmark, risk_free, base_currency)
+    unchanged = not_modified(etag)
+    if unchanged is not None:
+        return unchanged
+
+    try:
+        with riskResultsLock:
+            risk = riskResults.get(etag)
+            if risk is not None:
+                riskResults.move_to_end(etag)
+
+        if risk is None:
+            cumulative_holdings = userTransactions.cumulative_holdings(portfolio_id)
+            if cumulative_holdings.empty:
+                return jsonify({'Result': "No risk worked out as data couldn't be located", }), 200
+            risk = calculating_portfolio_risk(cumulative_holdings, start_date, end_date, benchmark, risk_free, base_currency)
+
+            #Kept under the tag as it is now, after any prices that were just saved
+            etag = portfolio_data_tag(portfolio_id, start_date, end_date, 'risk', benchmark, risk_free, base_currency)
+            with riskResultsLock:
+                riskResults[etag] = risk
+                while len(riskResults) > RISK_CACHE_SIZE:
+                    riskResults.popitem(last=False)
+
+        response = jsonify(risk)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response, 200
+
+    except MissingRateError as noRate:
+        return jsonify({'error': str(noRate), 'missing_rates': noRate.symbols}), 503
+
+    #Catching the last place as always
+    except Exception as noRisk:
+        return jsonify({'Couldnt work out the portfolio risk due to error': str(noRisk)}), 500
+
 #This method is responsible for allowing the user to see the classification of their stocks 
 #based on the different sectors they reside in, i.e (technological, medicial, business, etc)
-def stock_sectors(transactions_list):
+def stock_sectors(total_holdings, portfolio_data=None):
 
     #First we need to filitering out and classify what each of the stock 
-    #is based on the sector it has (we can call a previous method of calculate for that)
-    portfolio_data = calculating_portfolio_value(transactions_list)
-    positions = portfolio_data['positions']
+    #is based on the sector it has (we can call a previous method of calculate for that,
+    #unless the caller already has the summary in hand)
+    if portfolio_data is None:
+        portfolio_data = calculating_portfolio_value(total_holdings)
+    #Copies so the summary isn't changed, positions without an exchange rate aren't in the total either
+    positions = [dict(position) for position in portfolio_data['positions'] if not position.get('unconverted')]
     total_value = portfolio_data['total_value']
+    #The sectors come out of the local reference table, only a ticker that isn't in it
+    #yet gets looked up (anything that fails or takes too long just ends up as Unknown)
+    with requestMetrics.span('fetch'):
+        sector_info = symbolReference.get_many([position['ticker'] for position in positions])
+
     #Then we copy the similar structure of loop through the 
     #the totals per each of the sectors 
     for sector_position in positions:
@@ -427,15 +1110,7 @@ def stock_sectors(transactions_list):
         #We can use the previous call to get that information and begin loop
         #through to filter and classify them
         ticker = sector_position['ticker']
-
-        #Getting the sectors information
-        try:
-            stock = yStock.Ticker(ticker)
-            sector = stock.info.get('sector', 'Unknown')
-            sector_position['sector'] = sector  #Add sector to position
-
-        except:
-            sector_position['sector'] = 'Unknown'
+        sector_position['sector'] = sector_info.get(ticker, {}).get('sector', 'Unknown') #Add sector to position
         
     #Then once filiterd they need to be grouped by each of the sectors
     grouped_sectors = {}
@@ -477,22 +1152,201 @@ def stock_sectors(transactions_list):
 @app.route('/api/portfolio/<portfolio_id>/allocation', methods=['GET'])
 def getting_stock_sectors(portfolio_id):
 
+    base_currency, error = reading_base_currency(portfolio_id)
+    if error is not None:
+        return jsonify({'error': error}), 400
+
     #Filter out like usual 
     try:
-        date_range_portfolio = [transaction for transaction in userTransactions if transaction['portfolio_id'] == portfolio_id]
+        portfolio_holdings = reading_holdings(portfolio_id)
         #Then check that any of them are empty
-        if len(date_range_portfolio) == 0:
+        if len(portfolio_holdings) == 0:
             
             return jsonify({'name': "NA", 
                             'vlaue': 0,
                             'percent': 0}), 200
         
-        summary = stock_sectors(date_range_portfolio)
+        summary = stock_sectors(portfolio_holdings, calculating_portfolio_value(portfolio_holdings, base_currency))
         return jsonify(summary), 200
     
     #Catching the last place as always
     except Exception as noSummary:
         return jsonify({'Couldnt extract transaction information due to error': str(noSummary)}), 500
 
+#How often an idle stream sends a keep-alive (and checks for new trades in the portfolio)
+LIVE_HEARTBEAT = 15
+
+#Every open stream holds one of the gunicorn threads (WEB_THREADS) for as long as the client
+#stays connected, so only this many can be open at once and a few threads are always left
+#for every other request. The ones over the limit get a 503 and can try again later
+MAX_STREAMS = int(os.environ.get('MAX_STREAMS', max(int(os.environ.get('WEB_THREADS', 16)) - 4, 1)))
+streamSlots = threading.BoundedSemaphore(MAX_STREAMS)
+
+#Formats one server sent event
+def server_sent_event(event, data):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+#Streams the live value of the portfolio as server sent events. A 'snapshot' event with the
+#full summary comes first (and again whenever a trade is added), after that every 'update'
+#event only carries the positions whose price moved plus the new totals. The weights of the
+#positions that didn't move are left for the client to rescale against the new total
+@app.route('/api/portfolio/<portfolio_id>/stream', methods=['GET'])
+def streaming_portfolio(portfolio_id):
+
+    #Read now since the request is gone by the time the events are being sent
+    base_currency, error = reading_base_currency(portfolio_id)
+    if error is not None:
+        return jsonify({'error': error}), 400
+
+    if not streamSlots.acquire(blocking=False):
+        return jsonify({'error': 'Too many live streams open (%d), try again later' % MAX_STREAMS}), 503
+
+    def building_snapshot():
+        holdings = reading_holdings(portfolio_id)
+        if len(holdings) == 0:
+            return holdings, {'Result': "No summary created as data couldn't be located", 'positions': []}
+        return holdings, calculating_portfolio_value(holdings, base_currency)
+
+    #The poller deals in quoted prices, so the converted ones are turned back to seed it
+    def quoted_prices(positions):
+        return {ticker: position['current_price'] / position['fx_rate'] if position['fx_rate'] else 0
+                for ticker, position in positions.items() if not position.get('unconverted')}
+
+    def events():
+        version = userTransactions.version(portfolio_id)
+        holdings, summary = building_snapshot()
+        positions = {position['ticker']: position for position in summary['positions']}
+        total_value = summary.get('total_value', 0)
+        total_cost = summary.get('total_cost', 0)
+        subscription = livePrices.subscribe(quoted_prices(positions))
+
+        try:
+            yield server_sent_event('snapshot', summary)
+            while True:
+                try:
+                    moved = subscription.updates.get(timeout=LIVE_HEARTBEAT)
+                except queue.Empty:
+                    moved = None
+                    yield ': keep-alive\n\n'
+
+                #A new trade changes the holdings themselves so everything is redone
+                if userTransactions.version(portfolio_id) != version:
+                    version = userTransactions.version(portfolio_id)
+                    holdings, summary = building_snapshot()
+                    positions = {position['ticker']: position for position in summary['positions']}
+                    total_value = summary.get('total_value', 0)
+                    total_cost = summary.get('total_cost', 0)
+                    livePrices.resubscribe(subscription, quoted_prices(positions))
+                    yield server_sent_event('snapshot', summary)
+                    continue
+
+                if not moved:
+                    continue
+
+                #Only the positions whose price moved get worked out again (at the
+                #exchange rate of the last snapshot)
+                changed = []
+                for ticker, price in moved.items():
+                    if ticker not in positions or positions[ticker].get('unconverted'):
+                        continue
+                    position = calculating_position(ticker, holdings[ticker], price, positions[ticker]['fx_rate'])
+                    position['currency'] = positions[ticker]['currency']
+                    total_value += position['current_value'] - positions[ticker]['current_value']
+                    positions[ticker] = position
+                    changed.append(position)
+
+                for position in changed:
+                    position['weight'] = (position['current_value'] / total_value) * 100 if total_value > 0 else 0
+
+                update = calculating_portfolio_totals(total_value, total_cost, summary.get('realized_gain', 0))
+                update['positions'] = changed
+                yield server_sent_event('update', update)
+
+        finally:
+            livePrices.unsubscribe(subscription)
+
+    #The slot is given back once the server is done with the response, even when the
+    #client went away before the first event was sent
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(streamSlots.release)
+    return response
+
+#The dashboard needs all four of these, and asking for them separately repeats the
+#same holdings and price work four times over
+DASHBOARD_SECTIONS = ('summary', 'performance', 'allocation', 'transactions')
+
+#Builds everything the dashboard shows in one go: the holdings are read once, each price
+#and sector is fetched once, and the summary is reused for the allocation. The fields
+#query picks which sections come back (e.g. ?fields=summary,allocation), by default all
+@app.route('/api/portfolio/<portfolio_id>/dashboard', methods=['GET'])
+def getting_dashboard(portfolio_id):
+
+    fields = request.args.get('fields')
+    sections = DASHBOARD_SECTIONS if not fields else [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [section for section in sections if section not in DASHBOARD_SECTIONS]
+    if unknown:
+        return jsonify({'error': 'Unknown dashboard fields: ' + ', '.join(unknown),
+                        'fields': list(DASHBOARD_SECTIONS)}), 400
+
+    end_date = request.args.get('end_date', datetime.now().strftime('%Y-%m-%d'))
+    start_date = request.args.get('start_date', (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d'))
+    resolution, max_points, error = reading_downsampling_args()
+    if error is None:
+        base_currency, error = reading_base_currency(portfolio_id)
+    if error is not None:
+        return jsonify({'error': error}), 400
+
+    try:
+        dashboard = {'portfolio_id': portfolio_id}
+        portfolio_holdings = reading_holdings(portfolio_id)
+
+        #The summary is needed by the allocation too so it is only worked out once
+        summary = None
+        if len(portfolio_holdings) > 0 and ('summary' in sections or 'allocation' in sections):
+            summary = calculating_portfolio_value(portfolio_holdings, base_currency)
+
+        if 'summary' in sections:
+            if summary is None:
+                dashboard['summary'] = {'Result': "No summary created as data couldn't be located"}
+            else:
+                dashboard['summary'] = summary
+
+        if 'performance' in sections:
+            cumulative_holdings = userTransactions.cumulative_holdings(portfolio_id)
+            if cumulative_holdings.empty:
+                dashboard['performance'] = {'Result': "No summary created as data couldn't be located"}
+            else:
+                try:
+                    dashboard['performance'] = calculating_real_time_portfolio_data(cumulative_holdings, start_date, end_date, resolution, max_points, base_currency)
+                except MissingRateError as noRate:
+                    dashboard['performance'] = {'error': str(noRate), 'missing_rates': noRate.symbols}
+
+        if 'allocation' in sections:
+            if summary is None:
+                dashboard['allocation'] = {'name': "NA", 'vlaue': 0, 'percent': 0}
+            else:
+                dashboard['allocation'] = stock_sectors(portfolio_holdings, summary)
+
+        if 'transactions' in sections:
+            portfolio_transactions = userTransactions.for_portfolio(portfolio_id)
+            dashboard['transactions'] = {
+                "transactions": portfolio_transactions,
+                "count": len(portfolio_transactions),
+                "portfolio_id": portfolio_id
+            }
+
+        return jsonify(dashboard), 200
+
+    #Catching the last place as always
+    except Exception as noDashboard:
+        return jsonify({'Couldnt build the dashboard due to error': str(noDashboard)}), 500
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    #With debug on the reloader starts a second copy of this file that does the actual
+    #serving, only that copy should open the saved data (otherwise it happens on the first request)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        opening_saved_data()
+    #The dev server handles each request on its own thread so one slow call doesn't hold
+    #up the rest, for production use gunicorn (gunicorn.conf.py)
+    app.run(host="0.0.0.0", port=5000, debug=True, threaded=True)
\ No newline at end of file
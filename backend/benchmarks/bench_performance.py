@@ -0,0 +1,144 @@
+#Compares the old day by day loop of the /performance calculation against the
+#vectorized version, checking that both give back the same series
+#Run from the backend folder with: python benchmarks/bench_performance.py
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MARKET_DATA_PROVIDER', 'fixture')
+os.environ.setdefault('PRICE_STORE_PATH', ':memory:')
+os.environ.setdefault('SYMBOL_REFERENCE_PATH', ':memory:')
+os.environ.setdefault('TRANSACTION_LOG_DIR', '')
+
+import app
+from providers import FixtureProvider, save_fixture
+from transaction_store import TransactionStore
+
+#The original implementation, kept here only so the new one has something to be measured against
+def legacy_real_time_portfolio_data(transactions_lists, start_date, end_date):
+    data_range = pd.date_range(start=start_date, end=end_date, freq='D')
+    stock_tickers = set([t['ticker'] for t in transactions_lists])
+
+    price_data = {}
+    for ticker in stock_tickers:
+        price_data[ticker] = app.marketData.get_history(ticker, start_date, end_date)
+
+    dates_list = []
+    values_list = []
+    for current_date in data_range:
+        transaction_range = [t for t in transactions_lists
+            if datetime.strptime(t['purchase_date'], '%Y-%m-%d') <= current_date
+        ]
+
+        daily_holdings = {}
+        for holdings in transaction_range:
+            tickers = holdings['ticker']
+            if tickers not in daily_holdings:
+                daily_holdings[tickers] = {'shares': 0, 'total_cost': 0}
+            daily_holdings[tickers]['shares'] += holdings['shares']
+            daily_holdings[tickers]['total_cost'] += holdings['shares'] * holdings['purchase_price']
+
+        total_value_of_stocks = 0
+        for ticker, data in daily_holdings.items():
+            data_shares = data['shares']
+            try:
+                date_key = current_date.date()
+                if date_key in price_data[ticker].index.date:
+                    price = price_data[ticker].loc[current_date]['Close']
+                    total_value_of_stocks += data_shares * price
+                else:
+                    available_dates = price_data[ticker].index[price_data[ticker].index <= current_date]
+                    if len(available_dates) > 0:
+                        last_date = available_dates[-1]
+                        price = price_data[ticker].loc[last_date]['Close']
+                        total_value_of_stocks += data_shares * price
+            except Exception:
+                pass
+
+        dates_list.append(current_date.strftime('%Y-%m-%d'))
+        values_list.append(total_value_of_stocks)
+
+    return {'dates': dates_list, 'values': values_list}
+
+#Writes random walk closes on business days for every ticker into a fixture folder
+def building_fixtures(directory, tickers, start_date, end_date, seed):
+    rng = np.random.default_rng(seed)
+    business_days = pd.bdate_range(start_date, end_date)
+    for ticker in tickers:
+        closes = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, len(business_days))))
+        save_fixture(directory, ticker, info={'symbol': ticker, 'currency': 'USD'},
+                     history=pd.DataFrame({'Close': closes}, index=business_days))
+
+def building_transactions(tickers, count, start_date, end_date, seed):
+    rand = random.Random(seed)
+    days = pd.date_range(start_date, end_date, freq='D').strftime('%Y-%m-%d').tolist()
+    return [{
+        'portfolio_id': 'bench',
+        'ticker': rand.choice(tickers),
+        'shares': float(rand.randint(1, 50)),
+        'purchase_date': rand.choice(days),
+        'purchase_price': round(rand.uniform(10, 500), 2)
+    } for _ in range(count)]
+
+def timing(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=2000)
+    parser.add_argument('--tickers', type=int, default=25)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    end_date = pd.Timestamp('2024-12-31')
+    start_date = end_date - pd.Timedelta(days=args.days)
+    tickers = ['T%03d' % number for number in range(args.tickers)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        building_fixtures(directory, tickers, start_date - pd.Timedelta(days=30), end_date, args.seed)
+        app.set_market_data_provider(FixtureProvider(directory))
+        transactions = building_transactions(tickers, args.transactions, start_date - pd.Timedelta(days=30), end_date, args.seed)
+
+        start = start_date.strftime('%Y-%m-%d')
+        end = end_date.strftime('%Y-%m-%d')
+
+        store = TransactionStore()
+        for transaction in transactions:
+            store.add('bench', dict(transaction))
+        log_time, cumulative_holdings = timing(store.cumulative_holdings, 'bench', repeat=1)
+
+        #Warm up the fixture reads so only the calculation itself is timed
+        app.calculating_real_time_portfolio_data(cumulative_holdings, start, end)
+
+        legacy_time, legacy_result = timing(legacy_real_time_portfolio_data, transactions, start, end, repeat=1)
+        vector_time, vector_result = timing(app.calculating_real_time_portfolio_data, cumulative_holdings, start, end)
+
+    same_dates = legacy_result['dates'] == vector_result['dates']
+    same_values = np.allclose(legacy_result['values'], vector_result['values'], rtol=1e-9, atol=1e-6)
+
+    print('transactions=%d tickers=%d days=%d' % (args.transactions, args.tickers, args.days))
+    print('legacy loop:  %8.1f ms' % (legacy_time * 1000))
+    print('holdings log: %8.1f ms (built once per portfolio change)' % (log_time * 1000))
+    print('vectorized:   %8.1f ms' % (vector_time * 1000))
+    print('speedup:      %8.1fx' % (legacy_time / vector_time))
+    print('same output:  %s' % (same_dates and same_values))
+    if not (same_dates and same_values):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#Measures how fast transactions can be written through the log and how long a
+#restart takes, both from a snapshot and from replaying the whole log
+#Run from the backend folder with: python benchmarks/bench_persistence.py --transactions 1000000
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transaction_log import TransactionLog
+from transaction_store import TransactionStore
+
+def building_transaction(rand, portfolio_id):
+    return {
+        'portfolio_id': portfolio_id,
+        'ticker': 'T%03d' % rand.randrange(200),
+        'shares': float(rand.randint(1, 50)),
+        'purchase_date': '20%02d-%02d-%02d' % (rand.randint(15, 24), rand.randint(1, 12), rand.randint(1, 28)),
+        'purchase_price': round(rand.uniform(10, 500), 2),
+        'time_stamp': '2024-01-01 00:00:00'
+    }
+
+#Opens a store on top of the log directory the same way the app does on startup
+def opening(directory, snapshot_every):
+    log = TransactionLog(directory, snapshot_every=snapshot_every, snapshot_interval=3600)
+    store = TransactionStore()
+    state, records = log.recover()
+    if state is not None:
+        store.load_state(state['transactions'])
+    for kind, data in records:
+        if kind == 'transaction':
+            store.replay(data)
+    store.log = log
+    log.start(lambda: ({'transactions': store.dump_state(while_locked=log.rotate)[0], 'portfolios': {}}, log.generation - 1))
+    return store, log, len(records)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--portfolios', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--writers', type=int, default=32)
+    parser.add_argument('--single-writes', type=int, default=20000)
+    args = parser.parse_args()
+
+    rand = random.Random(11)
+    portfolio_ids = ['portfolio_%d' % number for number in range(args.portfolios)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        store, log, _ = opening(directory, snapshot_every=args.transactions * 10)
+
+        #Bulk writes, one log append and fsync per batch
+        started = time.perf_counter()
+        written = 0
+        while written < args.transactions:
+            count = min(args.batch, args.transactions - written)
+            portfolio_id = rand.choice(portfolio_ids)
+            store.add_many(portfolio_id, [building_transaction(rand, portfolio_id) for _ in range(count)])
+            written += count
+        bulk_time = time.perf_counter() - started
+
+        #Many single writes at once, each waits for its own fsync but they get grouped
+        per_writer = args.single_writes // args.writers
+        def writing(seed):
+            writer_rand = random.Random(seed)
+            for _ in range(per_writer):
+                portfolio_id = writer_rand.choice(portfolio_ids)
+                store.add(portfolio_id, building_transaction(writer_rand, portfolio_id))
+        fsyncs_before = log.fsyncs
+        started = time.perf_counter()
+        writers = [threading.Thread(target=writing, args=(seed,)) for seed in range(args.writers)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        single_time = time.perf_counter() - started
+        single_fsyncs = log.fsyncs - fsyncs_before
+        total = len(store)
+        log.close()
+
+        #Restart with nothing but the log to replay
+        started = time.perf_counter()
+        store, log, replayed = opening(directory, snapshot_every=args.transactions * 10)
+        replay_time = time.perf_counter() - started
+        assert len(store) == total
+
+        started = time.perf_counter()
+        log.snapshot()
+        snapshot_time = time.perf_counter() - started
+        snapshot_size = os.path.getsize(os.path.join(directory, 'snapshot.bin'))
+        log.close()
+
+        #Restart from the snapshot plus a short log tail
+        store, log, _ = opening(directory, snapshot_every=args.transactions * 10)
+        tail = 1000
+        store.add_many(portfolio_ids[0], [building_transaction(rand, portfolio_ids[0]) for _ in range(tail)])
+        log.close()
+        started = time.perf_counter()
+        store, log, tail_replayed = opening(directory, snapshot_every=args.transactions * 10)
+        snapshot_start_time = time.perf_counter() - started
+        assert len(store) == total + tail
+        log.close()
+
+    print('transactions:             %d across %d portfolios' % (total, args.portfolios))
+    print('bulk writes (batch %d): %10.0f tx/s' % (args.batch, args.transactions / bulk_time))
+    print('single writes (%d threads): %8.0f tx/s, %d fsyncs for %d writes' % (args.writers, (per_writer * args.writers) / single_time, single_fsyncs, per_writer * args.writers))
+    print('startup, full log replay: %8.2f s (%d records)' % (replay_time, replayed))
+    print('snapshot write:           %8.2f s (%.1f MB)' % (snapshot_time, snapshot_size / 1e6))
+    print('startup, snapshot + tail: %8.2f s (%d records replayed)' % (snapshot_start_time, tail_replayed))
+
+if __name__ == '__main__':
+    main()
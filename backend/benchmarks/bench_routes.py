@@ -0,0 +1,356 @@
+#Benchmarks every backend route against synthetic portfolios, with the offline fixture
+#provider standing in for yfinance so runs are reproducible and need no network. For each
+#scenario it records the cold (empty caches) and warm latency of every route (p50/p99),
+#the peak memory of one call, and the throughput and latency of a mixed concurrent load.
+#The results are written as JSON tagged with the git commit so runs can be compared.
+#Run from the backend folder with:
+#   python benchmarks/bench_routes.py                                  (small and medium scenarios)
+#   python benchmarks/bench_routes.py --scenarios large --requests 20
+#   python benchmarks/bench_routes.py --transactions 5000 --tickers 100 --years 3
+#   python benchmarks/bench_routes.py --compare benchmarks/results/<older run>.json
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MARKET_DATA_PROVIDER', 'fixture')
+os.environ.setdefault('PRICE_STORE_PATH', ':memory:')
+os.environ.setdefault('SYMBOL_REFERENCE_PATH', ':memory:')
+os.environ.setdefault('TRANSACTION_LOG_DIR', '')
+
+import app
+from providers import FixtureProvider, save_fixture, upstreamCalls
+from transaction_store import TransactionStore
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+#(transactions, tickers, years of history)
+SCENARIOS = {
+    'tiny': (10, 1, 1),
+    'small': (1000, 25, 2),
+    'medium': (10000, 100, 5),
+    'large': (100000, 500, 10)
+}
+
+SECTORS = ['Technology', 'Healthcare', 'Financial Services', 'Energy', 'Industrials', 'Consumer Cyclical']
+PORTFOLIO_ID = 'bench'
+BENCHMARK = 'SPY'
+END_DATE = pd.Timestamp('2024-12-31') #Fixed so the same seed always gives the same data
+
+#Random walk closes on business days plus an info entry for every ticker (and the benchmark)
+def building_fixtures(directory, tickers, years, seed):
+    rng = np.random.default_rng(seed)
+    start_date = END_DATE - pd.DateOffset(years=years) - pd.Timedelta(days=30)
+    business_days = pd.bdate_range(start_date, END_DATE)
+    market = np.cumsum(rng.normal(0.0003, 0.01, len(business_days)))
+
+    for number, ticker in enumerate(tickers + [BENCHMARK]):
+        closes = 100 * np.exp(market * rng.uniform(0.5, 1.5) + np.cumsum(rng.normal(0, 0.01, len(business_days))))
+        info = {
+            'symbol': ticker,
+            'longName': ticker + ' Holdings',
+            'currentPrice': round(float(closes[-1]), 2),
+            'marketCap': int(rng.integers(10 ** 8, 10 ** 12)),
+            'sector': SECTORS[number % len(SECTORS)],
+            'industry': 'Industry %d' % (number % 20),
+            'currency': 'USD'
+        }
+        save_fixture(directory, ticker, info=info, history=pd.DataFrame({'Close': closes}, index=business_days))
+
+#Buys spread over the range with the odd sell of part of what is held, as a CSV import body
+def building_import(tickers, count, years, seed):
+    rand = random.Random(seed)
+    days = pd.date_range(END_DATE - pd.DateOffset(years=years), END_DATE, freq='D').strftime('%Y-%m-%d').tolist()
+    held = {}
+    lines = ['ticker,shares,purchase_date,purchase_price,side']
+    for day in sorted(rand.choice(days) for _ in range(count)):
+        ticker = rand.choice(tickers)
+        if held.get(ticker, 0) > 10 and rand.random() < 0.2:
+            shares = held[ticker] // 2
+            held[ticker] -= shares
+            lines.append('%s,%d,%s,%.2f,sell' % (ticker, shares, day, rand.uniform(10, 500)))
+        else:
+            shares = rand.randint(1, 50)
+            held[ticker] = held.get(ticker, 0) + shares
+            lines.append('%s,%d,%s,%.2f,buy' % (ticker, shares, day, rand.uniform(10, 500)))
+    return '\n'.join(lines) + '\n'
+
+#Starts the app over from nothing with the scenario's fixtures as its market data
+def resetting_app(directory, latency):
+    app.set_market_data_provider(FixtureProvider(directory, latency=latency))
+    app.userTransactions = TransactionStore()
+    app.userPortfolios.clear()
+    clearing_caches()
+
+def clearing_caches():
+    app.quoteCache.clear()
+    app.priceStore.clear()
+    app.symbolReference.clear()
+    with app.riskResultsLock:
+        app.riskResults.clear()
+
+#The GET routes that get timed, as (name, url)
+def building_routes(tickers, years):
+    start_date = (END_DATE - pd.DateOffset(years=years)).strftime('%Y-%m-%d')
+    end_date = END_DATE.strftime('%Y-%m-%d')
+    portfolio = '/api/portfolio/' + PORTFOLIO_ID
+    window = 'start_date=%s&end_date=%s' % (start_date, end_date)
+    return [
+        ('health', '/api/health'),
+        ('metrics', '/metrics'),
+        ('stock', '/api/stock/' + tickers[0]),
+        ('transactions', portfolio + '/transactions'),
+        ('settings', portfolio + '/settings'),
+        ('summary', portfolio + '/summary'),
+        ('performance', portfolio + '/performance?' + window),
+        ('performance_500_points', portfolio + '/performance?' + window + '&max_points=500'),
+        ('allocation', portfolio + '/allocation'),
+        ('risk', portfolio + '/risk?' + window + '&benchmark=' + BENCHMARK),
+        ('dashboard', portfolio + '/dashboard?' + window + '&max_points=500')
+    ]
+
+def percentile(samples, q):
+    return float(np.percentile(samples, q)) if samples else None
+
+def summarizing(latencies):
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': float(np.mean(latencies)) if latencies else None,
+        'max_ms': float(np.max(latencies)) if latencies else None
+    }
+
+#One timed request, returns (milliseconds, status, upstream calls it made)
+def timing_request(client, method, url, **kwargs):
+    started = time.perf_counter()
+    response = client.open(url, method=method, **kwargs)
+    response.get_data()
+    elapsed = (time.perf_counter() - started) * 1000
+    return elapsed, response.status_code, int(response.headers.get('X-Upstream-Calls', 0))
+
+#Peak memory the route allocates while handling one request (tracemalloc slows the
+#request down a lot, so this is its own request and not one of the timed ones)
+def measuring_memory(client, method, url, **kwargs):
+    tracemalloc.start()
+    try:
+        client.open(url, method=method, **kwargs).get_data()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024
+
+def benchmarking_route(client, url, requests):
+    #Cold: nothing cached and no prices saved, so this includes every upstream fetch
+    clearing_caches()
+    cold_ms, status, cold_upstream = timing_request(client, 'GET', url)
+
+    latencies = []
+    warm_upstream = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        elapsed, status, upstream = timing_request(client, 'GET', url)
+        latencies.append(elapsed)
+        warm_upstream += upstream
+    total_time = time.perf_counter() - started
+
+    result = summarizing(latencies)
+    result.update({
+        'status': status,
+        'cold_ms': cold_ms,
+        'cold_upstream_calls': cold_upstream,
+        'warm_upstream_calls': warm_upstream,
+        'throughput_rps': requests / total_time if total_time > 0 else None,
+        'peak_memory_kb': measuring_memory(client, 'GET', url)
+    })
+    return result
+
+#Time until the live stream sends its first (snapshot) event
+def benchmarking_stream(client, requests):
+    latencies = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = client.get('/api/portfolio/%s/stream' % PORTFOLIO_ID, buffered=False)
+        next(response.response)
+        latencies.append((time.perf_counter() - started) * 1000)
+        response.close()
+    result = summarizing(latencies)
+    result['status'] = response.status_code
+    return result
+
+#Single trades posted one after another (each one also changes the portfolio version,
+#so this is the worst case for every cached result)
+def benchmarking_writes(client, tickers, requests, seed):
+    rand = random.Random(seed)
+    latencies = []
+    for _ in range(requests):
+        trade = {'ticker': rand.choice(tickers), 'shares': rand.randint(1, 10),
+                 'purchase_date': END_DATE.strftime('%Y-%m-%d'), 'purchase_price': 100}
+        elapsed, status, _ = timing_request(client, 'POST', '/api/portfolio/%s/transaction' % PORTFOLIO_ID, json=trade)
+        latencies.append(elapsed)
+    result = summarizing(latencies)
+    result['status'] = status
+    return result
+
+#Several clients hitting a mix of the read routes at once, each thread has its own test client
+def running_load(routes, concurrency, total_requests, seed):
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    plan = [random.Random(seed + number).choice(routes)[1] for number in range(total_requests)]
+    threadClients = threading.local()
+
+    def starting_thread():
+        threadClients.client = app.app.test_client()
+
+    def sending(url):
+        elapsed, status, _ = timing_request(threadClients.client, 'GET', url)
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, initializer=starting_thread) as executor:
+        list(executor.map(sending, plan))
+    total_time = time.perf_counter() - started
+
+    result = summarizing(latencies)
+    result.update({
+        'concurrency': concurrency,
+        'throughput_rps': total_requests / total_time if total_time > 0 else None,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())}
+    })
+    return result
+
+def running_scenario(name, transactions, ticker_count, years, args):
+    print('scenario %s: %d transactions, %d tickers, %d years' % (name, transactions, ticker_count, years), flush=True)
+    tickers = ['T%03d' % number for number in range(ticker_count)]
+    scenario = {'name': name, 'transactions': transactions, 'tickers': ticker_count, 'years': years, 'routes': {}}
+
+    with tempfile.TemporaryDirectory() as directory:
+        building_fixtures(directory, tickers, years, args.seed)
+        resetting_app(directory, args.latency_ms / 1000)
+        client = app.app.test_client()
+
+        #Loading the portfolio is itself the bulk import route
+        body = building_import(tickers, transactions, years, args.seed)
+        elapsed, status, _ = timing_request(client, 'POST', '/api/portfolio/%s/transactions/import' % PORTFOLIO_ID,
+                                            data=body, content_type='text/csv')
+        scenario['routes']['import'] = {'requests': 1, 'p50_ms': elapsed, 'p99_ms': elapsed, 'status': status,
+                                        'rows_per_second': transactions / (elapsed / 1000) if elapsed > 0 else None}
+        scenario['stored_transactions'] = len(app.userTransactions)
+
+        routes = building_routes(tickers, years)
+        for route_name, url in routes:
+            scenario['routes'][route_name] = benchmarking_route(client, url, args.requests)
+            printing_route(route_name, scenario['routes'][route_name])
+
+        scenario['routes']['stream_first_event'] = benchmarking_stream(client, min(args.requests, 10))
+        printing_route('stream_first_event', scenario['routes']['stream_first_event'])
+
+        scenario['load'] = running_load(routes, args.concurrency, args.load_requests, args.seed)
+        print('  %-24s p50 %8.2f ms  p99 %8.2f ms  %8.1f req/s (%d threads)' % (
+            'concurrent load', scenario['load']['p50_ms'], scenario['load']['p99_ms'],
+            scenario['load']['throughput_rps'], args.concurrency), flush=True)
+
+        #Writes last, they change the portfolio that everything above was measured on
+        scenario['routes']['transaction'] = benchmarking_writes(client, tickers, args.requests, args.seed)
+        printing_route('transaction', scenario['routes']['transaction'])
+    return scenario
+
+def printing_route(name, result):
+    line = '  %-24s p50 %8.2f ms  p99 %8.2f ms' % (name, result['p50_ms'], result['p99_ms'])
+    if 'cold_ms' in result:
+        line += '  cold %8.2f ms  %7.0f KB peak' % (result['cold_ms'], result['peak_memory_kb'])
+    print(line, flush=True)
+
+def git_revision():
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=backend, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=backend,
+                               capture_output=True, text=True, check=True).stdout.strip() != ''
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+#Prints how the p50 of every route moved against an older results file
+def comparing(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print('\ncompared with %s (%s)' % (baseline_path, (baseline['git']['commit'] or 'unknown')[:10]))
+    old_scenarios = {scenario['name']: scenario for scenario in baseline['scenarios']}
+    for scenario in results['scenarios']:
+        old = old_scenarios.get(scenario['name'])
+        if old is None:
+            continue
+        print('scenario %s' % scenario['name'])
+        for route_name, result in scenario['routes'].items():
+            old_result = old['routes'].get(route_name)
+            if old_result is None or not old_result.get('p50_ms') or result.get('p50_ms') is None:
+                continue
+            change = (result['p50_ms'] / old_result['p50_ms'] - 1) * 100
+            print('  %-24s p50 %8.2f -> %8.2f ms (%+6.1f%%)' % (route_name, old_result['p50_ms'], result['p50_ms'], change))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', default='small,medium', help='Comma separated, out of ' + ', '.join(SCENARIOS))
+    parser.add_argument('--transactions', type=int, help='Run one custom scenario instead (with --tickers and --years)')
+    parser.add_argument('--tickers', type=int, default=50)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=50, help='Timed requests per route')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--load-requests', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Latency added to every fixture (upstream) call')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='Where to write the JSON results (default benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='Older results file to compare against')
+    args = parser.parse_args()
+
+    if args.transactions is not None:
+        scenarios = [('custom', args.transactions, args.tickers, args.years)]
+    else:
+        names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+        unknown = [name for name in names if name not in SCENARIOS]
+        if unknown:
+            parser.error('Unknown scenarios: ' + ', '.join(unknown))
+        scenarios = [(name,) + SCENARIOS[name] for name in names]
+
+    revision = git_revision()
+    results = {
+        'git': revision,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'scenarios': [running_scenario(name, transactions, tickers, years, args) for name, transactions, tickers, years in scenarios],
+        'upstream_calls': dict(upstreamCalls.totals)
+    }
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+        output = os.path.join(RESULTS_DIRECTORY, '%s%s.json' % ((revision['commit'] or 'unknown')[:12], '-dirty' if revision['dirty'] else ''))
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print('results written to %s' % output)
+
+    if args.compare:
+        comparing(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#Keeps the lots of one ticker in a portfolio so that sells can be matched against the
+#buys they close out (the trades have to be handed over in date order). Both FIFO (the oldest shares are sold first) and average cost are
+#kept up to date on every trade, so switching the portfolio between them is instant and
+#nothing ever has to be replayed. A trade costs O(1) on average: a buy appends one lot
+#and a sell only walks over the lots it uses up
+from array import array
+
+COST_BASIS_METHODS = ('fifo', 'average')
+
+#Shares left below this are float dust from selling everything
+EPSILON = 1e-9
+
+class TickerLots:
+    def __init__(self):
+        self.shares = 0.0
+
+        #The open FIFO lots as two parallel arrays, the lots before head are already sold
+        self._lot_shares = array('d')
+        self._lot_prices = array('d')
+        self._head = 0
+        self.fifo_cost = 0.0
+        self.fifo_realized = 0.0
+
+        #Average cost only needs the running total
+        self.average_cost = 0.0
+        self.average_realized = 0.0
+
+    def buy(self, shares, price):
+        self._lot_shares.append(shares)
+        self._lot_prices.append(price)
+        self.fifo_cost += shares * price
+        self.average_cost += shares * price
+        self.shares += shares
+
+    #The caller has to check there are enough shares first
+    def sell(self, shares, price):
+        proceeds = shares * price
+
+        #FIFO, used up lots are just skipped over by moving the head
+        remaining = shares
+        sold_cost = 0.0
+        while remaining > EPSILON and self._head < len(self._lot_shares):
+            lot = self._lot_shares[self._head]
+            used = min(lot, remaining)
+            sold_cost += used * self._lot_prices[self._head]
+            remaining -= used
+            if lot - used > EPSILON:
+                self._lot_shares[self._head] = lot - used
+            else:
+                self._head += 1
+        self.fifo_cost -= sold_cost
+        self.fifo_realized += proceeds - sold_cost
+        self._compacting()
+
+        #Average cost, the shares sold take their share of the total cost with them
+        average_sold_cost = self.average_cost * (shares / self.shares) if self.shares > 0 else 0.0
+        self.average_cost -= average_sold_cost
+        self.average_realized += proceeds - average_sold_cost
+
+        self.shares -= shares
+        if self.shares <= EPSILON:
+            self.shares = 0.0
+            self.fifo_cost = 0.0
+            self.average_cost = 0.0
+
+    #Drops the sold lots off the front once they make up half the arrays, so the memory
+    #stays in line with the open lots and the copy is paid for by the sells that got there
+    def _compacting(self):
+        if self._head > 32 and self._head * 2 > len(self._lot_shares):
+            self._lot_shares = self._lot_shares[self._head:]
+            self._lot_prices = self._lot_prices[self._head:]
+            self._head = 0
+
+    #The shares held, the cost of those shares and the gain already locked in by sells
+    def position(self, method='fifo'):
+        if method == 'average':
+            return {'shares': self.shares, 'total_cost': self.average_cost, 'realized_gain': self.average_realized}
+        return {'shares': self.shares, 'total_cost': self.fifo_cost, 'realized_gain': self.fifo_realized}
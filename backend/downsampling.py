@@ -0,0 +1,65 @@
+#Shrinks the daily value series of the performance chart so a range of several years
+#doesn't send (and draw) thousands of points. Either every week/month is cut down to
+#its last day, or the series is thinned to a set number of points with LTTB (largest
+#triangle three buckets), which keeps the peaks and dips that make the chart's shape
+import numpy as np
+import pandas as pd
+
+RESOLUTIONS = ('daily', 'weekly', 'monthly')
+
+#Pandas period each resolution groups the days by
+RESOLUTION_PERIODS = {'weekly': 'W', 'monthly': 'M'}
+
+#Takes the dates (as 'YYYY-MM-DD' strings) and values of the series and hands back
+#the shrunk ones, max_points is applied after the resolution
+def downsampling_series(dates, values, resolution='daily', max_points=None):
+    if resolution not in RESOLUTIONS:
+        raise ValueError('Unknown resolution %s, expected one of %s' % (resolution, ', '.join(RESOLUTIONS)))
+
+    index = pd.DatetimeIndex(dates)
+    values = np.asarray(values, dtype=float)
+
+    if resolution in RESOLUTION_PERIODS and len(index) > 0:
+        #The last day of each period is what the portfolio was worth when it ended,
+        #so the real date is kept rather than the end of the period (which can be in the future)
+        periods = index.to_period(RESOLUTION_PERIODS[resolution]).asi8
+        last_of_period = np.append(periods[1:] != periods[:-1], True)
+        index = index[last_of_period]
+        values = values[last_of_period]
+
+    if max_points is not None and len(values) > max_points:
+        keep = largest_triangle_three_buckets(index.asi8 // 86400000000000, values, max_points)
+        index = index[keep]
+        values = values[keep]
+
+    return index.strftime('%Y-%m-%d').tolist(), values.tolist()
+
+#Picks which points to keep (their positions, in order). The first and last are always
+#kept, the rest are split into equal buckets and from each bucket the point that makes the
+#biggest triangle with the point kept before it and the average of the next bucket wins
+def largest_triangle_three_buckets(x, y, max_points):
+    count = len(y)
+    if max_points >= count or count <= 2:
+        return np.arange(count)
+    if max_points < 3:
+        return np.array([0, count - 1])[:max(max_points, 1)]
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, count - 1, max_points - 1).astype(int) #Bucket boundaries between the two fixed ends
+
+    keep = np.empty(max_points, dtype=int)
+    keep[0] = 0
+    keep[-1] = count - 1
+    previous = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else count
+        next_x = x[next_start:next_end].mean()
+        next_y = y[next_start:next_end].mean()
+
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        keep[bucket + 1] = previous
+    return keep
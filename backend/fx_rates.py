@@ -0,0 +1,62 @@
+#Works out how the prices of each ticker get turned into the portfolio's base currency.
+#The rates themselves are just more symbols to the price store and quote cache (Yahoo
+#lists them as e.g. GBPUSD=X, the USD price of one GBP), so their daily history is saved
+#right next to the stock closes and the current rate is batched in with the stock prices
+DEFAULT_CURRENCY = 'USD'
+
+#Some exchanges quote in the minor unit, e.g. the LSE in pence (GBp), so those prices
+#have to be divided down before the rate of the main currency can be used
+MINOR_UNITS = {
+    'GBp': ('GBP', 0.01),
+    'GBX': ('GBP', 0.01),
+    'ZAc': ('ZAR', 0.01),
+    'ZAC': ('ZAR', 0.01),
+    'ILA': ('ILS', 0.01)
+}
+
+#Raised when a price can't be turned into the base currency because the rate is missing,
+#reporting a value of 0 instead would quietly make the totals wrong
+class MissingRateError(LookupError):
+    def __init__(self, symbols):
+        self.symbols = sorted(symbols)
+        super().__init__('No exchange rate available for ' + ', '.join(self.symbols))
+
+#Checks the base currency asked for, handing back its code or None when it isn't one
+def reading_currency(currency):
+    if not isinstance(currency, str):
+        return None
+    currency = currency.strip().upper()
+    if len(currency) != 3 or not currency.isalpha():
+        return None
+    return currency
+
+#The main currency and how much of it one quoted unit is worth
+def normalizing_currency(currency):
+    if not currency:
+        return DEFAULT_CURRENCY, 1.0
+    if currency in MINOR_UNITS:
+        return MINOR_UNITS[currency]
+    return currency.upper(), 1.0
+
+#The Yahoo symbol of the rate from one currency into the other (None when they are the same)
+def fx_symbol(from_currency, to_currency):
+    if from_currency == to_currency:
+        return None
+    return '%s%s=X' % (from_currency, to_currency)
+
+#Takes {ticker: quoted currency} and hands back {ticker: (rate symbol or None, factor)},
+#the price in the base currency being price * factor * rate. A ticker whose currency
+#isn't known (None) gets (None, None) since there is no telling which rate it needs
+def conversion_plan(currencies, base_currency):
+    plan = {}
+    for ticker, currency in currencies.items():
+        if currency is None:
+            plan[ticker] = (None, None)
+            continue
+        major, factor = normalizing_currency(currency)
+        plan[ticker] = (fx_symbol(major, base_currency), factor)
+    return plan
+
+#The distinct rate symbols a plan needs, in a fixed order
+def plan_symbols(plan):
+    return sorted(set(symbol for symbol, _ in plan.values() if symbol is not None))
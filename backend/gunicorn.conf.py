@@ -0,0 +1,29 @@
+#Production settings for running the backend with gunicorn
+#   gunicorn -c gunicorn.conf.py wsgi:app
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+#The portfolios live in the memory of the process that owns the transaction log, a second
+#worker would have its own copy that never sees the other's trades (and couldn't open the
+#log at all), so there is exactly one worker and it scales with threads instead
+workers = 1
+if int(os.environ.get('WEB_CONCURRENCY', 1)) != 1:
+    raise SystemExit('WEB_CONCURRENCY=%s is not supported, the backend runs as a single worker '
+                     '(use WEB_THREADS to handle more requests at once)' % os.environ['WEB_CONCURRENCY'])
+
+#Threads inside each worker, so a slow /performance call doesn't hold up /health or other users.
+#Every open live stream (/api/portfolio/<id>/stream) keeps one of these threads for as long as
+#the client is connected, so at most MAX_STREAMS of them (WEB_THREADS - 4 by default) are let
+#in at once and the rest get a 503. Raise both together to serve more live clients
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 16))
+
+#Long enough for a cold /performance over many tickers, the upstream calls themselves
+#give up after UPSTREAM_TIMEOUT seconds
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
@@ -0,0 +1,108 @@
+#Holds the one background poller that keeps the prices of every symbol someone is
+#watching up to date. However many clients are streaming, each distinct symbol is only
+#asked for once per tick, and every client just gets told which of its symbols moved
+import queue
+import threading
+import time
+
+LIVE_POLL_INTERVAL = 15 #Seconds between price checks
+
+#One client watching a set of symbols, the poller drops {symbol: price} of whatever
+#changed onto its queue
+class LiveSubscription:
+    def __init__(self, symbols):
+        self.symbols = set(symbols)
+        self.updates = queue.Queue()
+
+class LivePricePoller:
+    def __init__(self, fetcher, interval=LIVE_POLL_INTERVAL):
+        self.fetcher = fetcher #Function that takes a list of symbols and returns fresh {symbol: price}
+        self.interval = interval
+        self._subscriptions = set()
+        self._watchers = {} #symbol -> number of subscriptions watching it
+        self._prices = {} #symbol -> last price that was sent out
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.ticks = 0
+
+    #Takes {symbol: price the client already has}, so the first tick only reports real moves
+    def subscribe(self, symbols):
+        subscription = LiveSubscription(symbols)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            self._watching(subscription.symbols, 1)
+            self._seeding(symbols)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._polling, name='live-price-poller', daemon=True)
+                self._thread.start()
+        return subscription
+
+    #Swaps the symbols a subscription watches (e.g. after a new trade in the portfolio)
+    def resubscribe(self, subscription, symbols):
+        with self._lock:
+            self._watching(subscription.symbols, -1)
+            subscription.symbols = set(symbols)
+            self._watching(subscription.symbols, 1)
+            self._seeding(symbols)
+
+    def _seeding(self, symbols):
+        for symbol, price in symbols.items():
+            if price and symbol not in self._prices:
+                self._prices[symbol] = price
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.discard(subscription)
+                self._watching(subscription.symbols, -1)
+
+    def _watching(self, symbols, change):
+        for symbol in symbols:
+            count = self._watchers.get(symbol, 0) + change
+            if count > 0:
+                self._watchers[symbol] = count
+            else:
+                self._watchers.pop(symbol, None)
+                self._prices.pop(symbol, None)
+
+    def _polling(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.tick()
+            except Exception:
+                pass #A bad tick just means nobody hears anything until the next one
+            self._wake.wait(max(0, self.interval - (time.monotonic() - started)))
+            self._wake.clear()
+
+    #Fetches every watched symbol once and tells each subscription what changed for it
+    def tick(self):
+        with self._lock:
+            symbols = list(self._watchers)
+        if not symbols:
+            return
+
+        prices = self.fetcher(symbols)
+
+        with self._lock:
+            self.ticks += 1
+            changed = {}
+            for symbol, price in prices.items():
+                if symbol in self._watchers and price and self._prices.get(symbol) != price:
+                    self._prices[symbol] = price
+                    changed[symbol] = price
+            if not changed:
+                return
+            for subscription in self._subscriptions:
+                moved = {symbol: price for symbol, price in changed.items() if symbol in subscription.symbols}
+                if moved:
+                    subscription.updates.put(moved)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': len(self._subscriptions),
+                'symbols': len(self._watchers),
+                'ticks': self.ticks
+            }
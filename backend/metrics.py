@@ -0,0 +1,140 @@
+#Keeps track of where the time of every request goes and hands it all out in the
+#Prometheus text format on /metrics. Each request is split into stages: fetch (prices,
+#history and metadata, from the caches or upstream), serialization (turning the result
+#into JSON), compression, and aggregation (everything else the route does with the data)
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+#Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#The stages a request can spend its time in, aggregation is whatever is left over
+STAGES = ('fetch', 'aggregation', 'serialization', 'compression')
+
+def _escaping(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escaping(value)) for name, value in zip(names, values)) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+#Writes out one metric family, samples being [(label values, value), ...]
+def metric_family(name, kind, help_text, samples, label_names=()):
+    lines = ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, kind)]
+    for label_values, value in samples:
+        lines.append('%s%s %s' % (name, _labels(label_names, label_values), _number(value)))
+    return lines
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {} #label values -> [count per bucket..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for number, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[number] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        names = self.label_names + ('le',)
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets + (float('inf'),), series[:len(self.buckets)] + [series[-1]]):
+                    lines.append('%s_bucket%s %d' % (self.name, _labels(names, label_values + (_number(bound),)), count))
+                lines.append('%s_sum%s %s' % (self.name, _labels(self.label_names, label_values), repr(series[-2])))
+                lines.append('%s_count%s %d' % (self.name, _labels(self.label_names, label_values), series[-1]))
+        return lines
+
+#The timing of the request being handled on this thread (or task), along with the
+#histograms every finished request is added to
+class RequestMetrics:
+    def __init__(self):
+        self._current = ContextVar('request_timing', default=None)
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.in_flight = 0
+        self.durations = Histogram('http_request_duration_seconds', 'Time taken to handle each request',
+                                   ('route', 'method', 'status'))
+        self.stages = Histogram('http_request_stage_seconds', 'Time each request spent in each stage',
+                                ('route', 'stage'))
+
+    def start_request(self):
+        self._current.set({'started': time.perf_counter(), 'stages': {}, 'open': {}})
+        with self._lock:
+            self.in_flight += 1
+
+    #Counts the time spent inside the block towards the stage, a span inside another
+    #span of the same stage (e.g. a fetch helper called from a fetch) only counts once
+    @contextmanager
+    def span(self, stage):
+        current = self._current.get()
+        if current is None or current['open'].get(stage):
+            yield
+            return
+        current['open'][stage] = True
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            current['stages'][stage] = current['stages'].get(stage, 0) + time.perf_counter() - started
+            current['open'][stage] = False
+
+    #Adds the finished request to the histograms and hands back {stage: seconds} with the total
+    def finish_request(self, route, method, status):
+        current = self._current.get()
+        if current is None:
+            return {}
+        total = time.perf_counter() - current['started']
+        timings = dict(current['stages'])
+        timings['aggregation'] = max(total - sum(timings.values()), 0)
+        timings['total'] = total
+
+        self.durations.observe((route, method, str(status)), total)
+        for stage in STAGES:
+            if stage in timings:
+                self.stages.observe((route, stage), timings[stage])
+        return timings
+
+    #Called once the request is completely done, even when it failed
+    def end_request(self):
+        if self._current.get() is None:
+            return
+        self._current.set(None)
+        with self._lock:
+            self.in_flight -= 1
+
+    def uptime(self):
+        return time.time() - self.started_at
+
+    def render(self):
+        lines = self.durations.render() + self.stages.render()
+        with self._lock:
+            lines += metric_family('http_requests_in_flight', 'gauge', 'Requests being handled right now', [((), self.in_flight)])
+        lines += metric_family('process_uptime_seconds', 'gauge', 'Seconds since the service started', [((), self.uptime())])
+        lines += metric_family('process_start_time_seconds', 'gauge', 'Unix time the service started', [((), self.started_at)])
+        return lines
+
+#The value of the Server-Timing header for the timings of a request
+def server_timing(timings):
+    return ', '.join('%s;dur=%.2f' % (stage, seconds * 1000) for stage, seconds in timings.items())
+
+requestMetrics = RequestMetrics()
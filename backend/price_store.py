@@ -0,0 +1,224 @@
+#Holds the local copy of the daily close history so that /performance doesn't have to
+#download the same (never changing) closes again on every request. Everything lives in
+#one SQLite file, and for each symbol we remember which range of dates is already
+#saved so that only the missing days before or after it get fetched from the provider
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+#Today's bar is still moving so it is never marked as saved, this is how long we wait
+#before asking the provider for it again
+OPEN_DAY_TTL = 60
+
+#A range the provider had nothing for isn't marked as saved (yfinance also hands back
+#nothing when it is rate limiting us), it is only asked for again after this long
+EMPTY_RETRY_TTL = 15 * 60
+
+#Weekdays can still be exchange holidays, so a reply for a range that ended over a week ago
+#(the provider has long since settled it) may stop this many weekdays short and still count
+HOLIDAY_SLACK_DAYS = 3
+SETTLED_AFTER_DAYS = 7
+
+#How much of the file SQLite is allowed to memory map for reads
+MMAP_SIZE = 256 * 1024 * 1024
+
+#How many symbols keep their saved closes decoded in memory, reading a few years of
+#a few hundred symbols out of SQLite row by row is far slower than slicing arrays
+MAX_CACHED_SERIES = 2048
+
+class PriceStore:
+    def __init__(self, path, fetcher):
+        self.path = path
+        self.fetcher = fetcher #Function (symbol, start, end) -> history frame with a Close column
+        self.version = 0 #Goes up every time new prices get saved
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._symbol_locks = {}
+        self._open_day_fetches = {}
+        self._empty_fetches = {} #symbol -> [(start, end, when)] of the ranges that came back empty
+        self._series = OrderedDict() #symbol -> (days, closes) arrays of everything saved for it
+
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('PRAGMA mmap_size=%d' % MMAP_SIZE)
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS prices (
+                symbol TEXT NOT NULL, date TEXT NOT NULL, close REAL,
+                PRIMARY KEY (symbol, date)) WITHOUT ROWID''')
+            #The [start, end) range of dates that has already been fetched for the symbol
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS coverage (
+                symbol TEXT PRIMARY KEY, start TEXT NOT NULL, end TEXT NOT NULL)''')
+            self._connection.commit()
+
+    def _symbol_lock(self, symbol):
+        with self._lock:
+            if symbol not in self._symbol_locks:
+                self._symbol_locks[symbol] = threading.Lock()
+            return self._symbol_locks[symbol]
+
+    def _coverage(self, symbol):
+        with self._lock:
+            row = self._connection.execute('SELECT start, end FROM coverage WHERE symbol = ?', (symbol,)).fetchone()
+        return row
+
+    #Works out which date ranges are missing for the request, given what is already saved
+    def _missing_ranges(self, symbol, start, end):
+        coverage = self._coverage(symbol)
+        if coverage is None:
+            return [(start, end)]
+
+        covered_start, covered_end = coverage
+        missing = []
+        if start < covered_start:
+            missing.append((start, covered_start))
+        if end > covered_end:
+            #Always fetch on from the end of what we have so the saved range stays in one piece
+            missing.append((covered_end, end))
+        return missing
+
+    def _save(self, symbol, history, start, end):
+        rows = []
+        if history is not None and not history.empty:
+            closes = history['Close']
+            rows = [(symbol, day.strftime('%Y-%m-%d'), float(close)) for day, close in closes.items() if pd.notna(close)]
+
+        #Only the days that are finished count as saved, today gets asked for again later.
+        #The range is only saved up to the last day that actually came back, so a reply
+        #that was cut short (or empty) gets the rest asked for again
+        #(days after it that are all weekend can't have anything in them, so those still count,
+        #and so do a few holidays at the end of a settled range)
+        today = datetime.now().strftime('%Y-%m-%d')
+        end = min(end, today)
+        missing_from = (pd.Timestamp(max(row[1] for row in rows)) + pd.Timedelta(days=1)).strftime('%Y-%m-%d') if rows else start
+        if missing_from < end:
+            missing_days = np.busday_count(missing_from, end)
+            settled = end <= (datetime.now() - pd.Timedelta(days=SETTLED_AFTER_DAYS)).strftime('%Y-%m-%d')
+            if missing_days > (HOLIDAY_SLACK_DAYS if rows and settled else 0):
+                end = missing_from
+
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO prices (symbol, date, close) VALUES (?, ?, ?)', rows)
+            if start < end:
+                coverage = self._connection.execute('SELECT start, end FROM coverage WHERE symbol = ?', (symbol,)).fetchone()
+                if coverage is not None and (end < coverage[0] or start > coverage[1]):
+                    #Doesn't touch what was saved before, so the days in between would get
+                    #marked as saved too. The closes are kept but the range is asked for again
+                    start, end = coverage
+                elif coverage is not None:
+                    start = min(start, coverage[0])
+                    end = max(end, coverage[1])
+                self._connection.execute('INSERT OR REPLACE INTO coverage (symbol, start, end) VALUES (?, ?, ?)', (symbol, start, end))
+            self._connection.commit()
+            if rows:
+                self._series.pop(symbol, None)
+                self.version += 1
+
+    #Fetches whatever part of [start, end) isn't saved yet, the range that runs into today
+    #is only asked for again once OPEN_DAY_TTL has passed
+    def _fill_gaps(self, symbol, start, end):
+        today = datetime.now().strftime('%Y-%m-%d')
+        for gap_start, gap_end in self._missing_ranges(symbol, start, end):
+            if gap_end > today:
+                last_fetch = self._open_day_fetches.get(symbol)
+                if last_fetch is not None and last_fetch[0] <= gap_start and time.monotonic() - last_fetch[1] < OPEN_DAY_TTL:
+                    continue
+                self._open_day_fetches[symbol] = (gap_start, time.monotonic())
+            if self._recently_empty(symbol, gap_start, gap_end):
+                continue
+            history = self.fetcher(symbol, gap_start, gap_end)
+            if history is None or history.empty:
+                self._empty_fetches.setdefault(symbol, []).append((gap_start, gap_end, time.monotonic()))
+            self._save(symbol, history, gap_start, gap_end)
+
+    #Whether the range is inside one that came back empty less than EMPTY_RETRY_TTL ago
+    def _recently_empty(self, symbol, start, end):
+        now = time.monotonic()
+        fetches = [fetch for fetch in self._empty_fetches.get(symbol, ()) if now - fetch[2] < EMPTY_RETRY_TTL]
+        if fetches:
+            self._empty_fetches[symbol] = fetches
+        else:
+            self._empty_fetches.pop(symbol, None)
+        return any(fetch_start <= start and end <= fetch_end for fetch_start, fetch_end, _ in fetches)
+
+    #Returns the saved closes of the symbol in [start, end) after fetching any missing days
+    def get_history(self, symbol, start, end):
+        symbol = symbol.upper()
+        start = pd.Timestamp(start).strftime('%Y-%m-%d')
+        end = pd.Timestamp(end).strftime('%Y-%m-%d')
+        self._filling(symbol, start, end)
+        return self._reading(symbol, start, end)
+
+    def _filling(self, symbol, start, end):
+        if start < end:
+            with self._symbol_lock(symbol):
+                try:
+                    self._fill_gaps(symbol, start, end)
+                except Exception:
+                    pass #Hand back whatever we have saved if the provider fails
+
+    #Everything saved for the symbol as two arrays (days, closes), read out of SQLite
+    #once and then kept until new closes are saved for it
+    def _loading_series(self, symbol):
+        with self._lock:
+            series = self._series.get(symbol)
+            if series is not None:
+                self._series.move_to_end(symbol)
+                return series
+
+            rows = self._connection.execute('SELECT date, close FROM prices WHERE symbol = ? ORDER BY date', (symbol,)).fetchall()
+            series = (np.array([row[0] for row in rows], dtype='datetime64[D]'),
+                      np.array([row[1] for row in rows], dtype='float64'))
+            self._series[symbol] = series
+            while len(self._series) > MAX_CACHED_SERIES:
+                self._series.popitem(last=False)
+            return series
+
+    def _reading(self, symbol, start, end):
+        days, closes = self._loading_series(symbol.upper())
+        first = np.searchsorted(days, np.datetime64(pd.Timestamp(start).strftime('%Y-%m-%d'), 'D'))
+        last = np.searchsorted(days, np.datetime64(pd.Timestamp(end).strftime('%Y-%m-%d'), 'D'))
+
+        index = pd.DatetimeIndex(days[first:last].astype('datetime64[ns]'), name='Date')
+        return pd.DataFrame({'Close': closes[first:last]}, index=index, dtype='float64')
+
+    #Same as get_history for several symbols. Only the symbols with days missing go to
+    #the provider (side by side and under its timeout when there is a pool to run them on),
+    #the rest are read straight from what is saved. Returns {symbol: history}
+    def get_histories(self, symbols, start, end, pool=None):
+        symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+        start = pd.Timestamp(start).strftime('%Y-%m-%d')
+        end = pd.Timestamp(end).strftime('%Y-%m-%d')
+
+        gaps = [symbol for symbol in symbols if start < end and self._missing_ranges(symbol, start, end)]
+        if pool is None:
+            for symbol in gaps:
+                self._filling(symbol, start, end)
+        else:
+            #A symbol that runs out of time still gets whatever was already saved for it
+            pool.map(lambda symbol: self._filling(symbol, start, end), gaps)
+
+        return {symbol: self._reading(symbol, start, end) for symbol in symbols}
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM prices')
+            self._connection.execute('DELETE FROM coverage')
+            self._connection.commit()
+            self._open_day_fetches.clear()
+            self._empty_fetches.clear()
+            self._series.clear()
+            self.version += 1
+
+    #Makes sure the database can still be read, raising if it can't
+    def ping(self):
+        with self._lock:
+            self._connection.execute('SELECT 1 FROM coverage LIMIT 1').fetchone()
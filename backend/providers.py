@@ -0,0 +1,292 @@
+#Holds the different places the backend can get its market data from, so that
+#the app isn't tied directly to yfinance and can also run off local files
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextvars import ContextVar, copy_context
+
+import pandas as pd
+
+#Need to get multiple field references to find the price since not every
+#stock fills in the same ones
+def find_stock_price(stock_info):
+    return (stock_info.get('currentPrice') or
+            stock_info.get('regularMarketPrice') or
+            stock_info.get('previousClose') or
+            stock_info.get('ask') or
+            stock_info.get('bid') or 0)
+
+#Keeps track of how many times we had to go upstream, both in total and for the
+#request that is currently running (the request sets up its own counter through a
+#context variable so calls made on its behalf from other threads still count)
+class UpstreamCallCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = ContextVar('upstream_calls', default=None)
+        self.totals = {}
+
+    def start_request(self):
+        self._current.set({'count': 0})
+
+    def request_count(self):
+        current = self._current.get()
+        return current['count'] if current is not None else 0
+
+    def record(self, kind):
+        with self._lock:
+            self.totals[kind] = self.totals.get(kind, 0) + 1
+            current = self._current.get()
+            if current is not None:
+                current['count'] += 1
+
+upstreamCalls = UpstreamCallCounter()
+
+#How many upstream calls can be running at once across the whole process, and how
+#long a request waits on any one of them before giving up on it
+UPSTREAM_CONCURRENCY = int(os.environ.get('UPSTREAM_CONCURRENCY', 8))
+UPSTREAM_TIMEOUT = float(os.environ.get('UPSTREAM_TIMEOUT', 10))
+
+#Runs the slow upstream calls on a shared, bounded set of threads so a request that needs
+#many symbols fetches them side by side instead of one after another. A call that goes past
+#its timeout is left behind (its result still lands in the caches when it finishes) but the
+#request carries on without it. A call made from one of the pool's own threads runs right
+#there instead, it is already under the timeout of the call it is part of and waiting on
+#another thread of the pool could leave every thread waiting on one another
+class UpstreamPool:
+    def __init__(self, max_workers=UPSTREAM_CONCURRENCY, timeout=UPSTREAM_TIMEOUT):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upstream')
+        self._worker = threading.local()
+        self.timeouts = 0
+        self.failures = 0
+
+    #Submits with a copy of the callers context so the calls still count towards its request
+    def _submit(self, function, *args):
+        return self._executor.submit(copy_context().run, self._running, function, *args)
+
+    def _running(self, function, *args):
+        self._worker.inside = True
+        try:
+            return function(*args)
+        finally:
+            self._worker.inside = False
+
+    def _inside(self):
+        return getattr(self._worker, 'inside', False)
+
+    #Runs one call, raising TimeoutError if it takes longer than the timeout
+    def call(self, function, *args, timeout=None):
+        if self._inside():
+            return function(*args)
+        try:
+            return self._submit(function, *args).result(timeout=timeout or self.timeout)
+        except FutureTimeoutError:
+            self.timeouts += 1
+            raise TimeoutError('Upstream call timed out after %.1fs' % (timeout or self.timeout))
+
+    #Runs function(item) for every item side by side and returns {item: result}, the
+    #items that failed or ran out of time are simply missing from the result
+    def map(self, function, items, timeout=None):
+        if self._inside():
+            results = {}
+            for item in items:
+                try:
+                    results[item] = function(item)
+                except Exception:
+                    self.failures += 1
+            return results
+
+        futures = {item: self._submit(function, item) for item in items}
+        deadline = time.monotonic() + (timeout or self.timeout)
+        results = {}
+        for item, future in futures.items():
+            try:
+                results[item] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                self.timeouts += 1
+            except Exception:
+                self.failures += 1
+        return results
+
+upstreamPool = UpstreamPool()
+
+#Every history frame handed back has a plain (timezone free) date index
+#and at least a Close column so the callers don't need to care where it came from
+def _empty_history():
+    return pd.DataFrame({'Close': pd.Series(dtype='float64')}, index=pd.DatetimeIndex([], name='Date'))
+
+#The base that every provider has to follow
+class MarketDataProvider:
+    name = 'base'
+
+    #Returns the info dictionary of a single symbol (same keys as yfinance .info)
+    def get_info(self, symbol):
+        raise NotImplementedError
+
+    #Returns {symbol: price} for every symbol a price could be found for
+    def get_batch_quotes(self, symbols):
+        quotes = {}
+        for symbol in symbols:
+            price = find_stock_price(self.get_info(symbol))
+            if price:
+                quotes[symbol] = price
+        return quotes
+
+    #Returns the daily history between start (inclusive) and end (exclusive)
+    def get_history(self, symbol, start, end):
+        raise NotImplementedError
+
+#The live provider that goes out to Yahoo through yfinance
+class YFinanceProvider(MarketDataProvider):
+    name = 'yfinance'
+
+    def __init__(self):
+        import yfinance #Only needed when we actually go online
+        self.yStock = yfinance
+
+    def get_info(self, symbol):
+        upstreamCalls.record('info')
+        return self.yStock.Ticker(symbol).info
+
+    #Grabs the latest close of every symbol with one download call instead
+    #of one .info round trip per symbol
+    def get_batch_quotes(self, symbols):
+        if not symbols:
+            return {}
+        upstreamCalls.record('batch_quotes')
+        download = self.yStock.download(list(symbols), period='5d', interval='1d', group_by='column',
+                                        auto_adjust=False, progress=False, threads=True)
+        if download is None or download.empty:
+            return {}
+
+        closes = download['Close']
+        if isinstance(closes, pd.Series): #Only one symbol was asked for
+            closes = closes.to_frame(name=symbols[0])
+
+        quotes = {}
+        for symbol in closes.columns:
+            latest = closes[symbol].dropna()
+            if not latest.empty:
+                quotes[str(symbol).upper()] = float(latest.iloc[-1])
+        return quotes
+
+    def get_history(self, symbol, start, end):
+        upstreamCalls.record('history')
+        stock_range = self.yStock.Ticker(symbol).history(start=start, end=end)
+        if stock_range.empty:
+            return _empty_history()
+        stock_range.index = stock_range.index.tz_localize(None)
+        return stock_range
+
+#The offline provider that replays data saved on disk, the layout of the directory is
+#   info.json                     -> {"AAPL": {...info...}, ...}
+#   history/AAPL.parquet or .csv  -> Date index plus Open/High/Low/Close/Volume columns
+#Every call can also be slowed down by a fixed latency to act like a real upstream
+class FixtureProvider(MarketDataProvider):
+    name = 'fixture'
+
+    def __init__(self, directory, latency=0.0):
+        self.directory = directory
+        self.latency = latency
+        self._info = None
+        self._history = {}
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _load_info(self):
+        with self._lock:
+            if self._info is None:
+                info_path = os.path.join(self.directory, 'info.json')
+                if os.path.exists(info_path):
+                    with open(info_path) as info_file:
+                        self._info = {symbol.upper(): info for symbol, info in json.load(info_file).items()}
+                else:
+                    self._info = {}
+            return self._info
+
+    def _load_history(self, symbol):
+        with self._lock:
+            if symbol in self._history:
+                return self._history[symbol]
+
+        history = _empty_history()
+        parquet_path = os.path.join(self.directory, 'history', symbol + '.parquet')
+        csv_path = os.path.join(self.directory, 'history', symbol + '.csv')
+        if os.path.exists(parquet_path):
+            history = pd.read_parquet(parquet_path)
+        elif os.path.exists(csv_path):
+            history = pd.read_csv(csv_path, index_col=0, parse_dates=True)
+        history.index = pd.DatetimeIndex(history.index).tz_localize(None)
+        history = history.sort_index()
+
+        with self._lock:
+            self._history[symbol] = history
+        return history
+
+    def get_info(self, symbol):
+        upstreamCalls.record('info')
+        self._wait()
+        #Copy so that callers can't change the fixture itself
+        return dict(self._load_info().get(symbol.upper(), {}))
+
+    def get_batch_quotes(self, symbols):
+        upstreamCalls.record('batch_quotes')
+        self._wait()
+        all_info = self._load_info()
+        quotes = {}
+        for symbol in symbols:
+            price = find_stock_price(all_info.get(symbol.upper(), {}))
+            if price:
+                quotes[symbol.upper()] = price
+        return quotes
+
+    def get_history(self, symbol, start, end):
+        upstreamCalls.record('history')
+        self._wait()
+        history = self._load_history(symbol.upper())
+        start = pd.Timestamp(start)
+        end = pd.Timestamp(end)
+        return history[(history.index >= start) & (history.index < end)].copy()
+
+#Writes a symbol into a fixture directory so it can be replayed by the FixtureProvider later
+def save_fixture(directory, symbol, info=None, history=None, file_format='csv'):
+    symbol = symbol.upper()
+    os.makedirs(os.path.join(directory, 'history'), exist_ok=True)
+
+    if info is not None:
+        info_path = os.path.join(directory, 'info.json')
+        all_info = {}
+        if os.path.exists(info_path):
+            with open(info_path) as info_file:
+                all_info = json.load(info_file)
+        all_info[symbol] = info
+        with open(info_path, 'w') as info_file:
+            json.dump(all_info, info_file)
+
+    if history is not None:
+        if file_format == 'parquet':
+            history.to_parquet(os.path.join(directory, 'history', symbol + '.parquet'))
+        else:
+            history.to_csv(os.path.join(directory, 'history', symbol + '.csv'), index_label='Date')
+
+#Picks the provider from the environment so the same app can run online or offline
+#   MARKET_DATA_PROVIDER = yfinance (default) or fixture
+#   MARKET_DATA_FIXTURES = directory for the fixture provider
+#   MARKET_DATA_LATENCY_MS = injected latency per call for the fixture provider
+def create_provider():
+    provider_name = os.environ.get('MARKET_DATA_PROVIDER', 'yfinance').lower()
+
+    if provider_name == 'fixture':
+        directory = os.environ.get('MARKET_DATA_FIXTURES', os.path.join(os.path.dirname(__file__), 'fixtures'))
+        latency = float(os.environ.get('MARKET_DATA_LATENCY_MS', 0)) / 1000
+        return FixtureProvider(directory, latency=latency)
+
+    if provider_name == 'yfinance':
+        return YFinanceProvider()
+
+    raise ValueError('Unknown market data provider: ' + provider_name)
@@ -0,0 +1,247 @@
+#Holds the in-process cache that sits in front of every stock info lookup so
+#that the same ticker isn't fetched over and over again within a page load
+import threading
+import time
+from collections import OrderedDict
+
+from providers import find_stock_price
+
+#Price fields move all day so they only stay fresh for a short time, everything
+#else (longName, sector, industry, etc) barely changes and can be kept much longer
+PRICE_FIELDS = {'currentPrice', 'regularMarketPrice', 'previousClose', 'ask', 'bid'}
+METADATA_FIELDS = ('longName', 'sector', 'industry', 'marketCap', 'currency')
+PRICE_TTL = 30
+METADATA_TTL = 6 * 60 * 60
+MAX_SYMBOLS = 512
+
+#Holds the result of a fetch that is currently happening so that other
+#requests for the same symbol can wait on it instead of fetching again. The result
+#is the info dictionary, or just the price when the symbol is part of a batch
+class _InflightFetch:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class QuoteCache:
+    def __init__(self, fetcher, batch_fetcher=None, pool=None, max_size=MAX_SYMBOLS, price_ttl=PRICE_TTL, metadata_ttl=METADATA_TTL):
+        self.fetcher = fetcher #Function that takes a symbol and returns its info dictionary
+        self.batch_fetcher = batch_fetcher #Function that takes a list of symbols and returns {symbol: price}
+        self.pool = pool #Optional UpstreamPool so several single lookups can run at once
+        self.max_size = max_size
+        self.price_ttl = price_ttl
+        self.metadata_ttl = metadata_ttl
+
+        #symbol -> {'info', 'info_at', 'price', 'price_at'}, oldest first. The price can be
+        #filled in by a batch lookup without us ever having fetched the full info
+        self._entries = OrderedDict()
+        self._inflight = {} #symbol -> _InflightFetch of its info
+        self._price_inflight = {} #symbol -> _InflightFetch of its price in a batch
+        self._lock = threading.Lock()
+
+        #Counters so we can see how well the cache is doing
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    #The max age an entry can have depends on which fields the caller wants,
+    #if any of them is a price field we have to use the short ttl
+    def _max_age(self, fields):
+        if fields is None:
+            return self.price_ttl
+        for field in fields:
+            if field in PRICE_FIELDS:
+                return self.price_ttl
+        return self.metadata_ttl
+
+    #Returns the info dictionary for the symbol, only going upstream if
+    #the cached copy is too old for the fields that were asked for
+    def get_info(self, symbol, fields=None):
+        symbol = symbol.upper()
+        max_age = self._max_age(fields)
+
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry is not None and entry['info'] is not None and time.monotonic() - entry['info_at'] < max_age:
+                self._entries.move_to_end(symbol)
+                self.hits += 1
+                return entry['info']
+            self.misses += 1
+
+            #Either join a fetch that is already running or become the one doing it
+            inflight = self._inflight.get(symbol)
+            leader = inflight is None
+            if leader:
+                inflight = _InflightFetch()
+                self._inflight[symbol] = inflight
+            else:
+                self.shared += 1
+
+        if not leader:
+            if not inflight.done.wait(self._wait_timeout()):
+                raise TimeoutError('Gave up waiting on the lookup of %s' % symbol)
+            if inflight.error is not None:
+                raise inflight.error
+            return inflight.result
+
+        try:
+            info = self.fetcher(symbol)
+            self._store(symbol, info)
+            inflight.result = info
+            return info
+        except Exception as error:
+            inflight.error = error
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(symbol, None)
+            inflight.done.set()
+
+    #Looks up several symbols at once (side by side and under its timeout when there is
+    #a pool), the ones that fail or time out are missing from the result
+    def get_many(self, symbols, fields=None):
+        symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+        if self.pool is None:
+            results = {}
+            for symbol in symbols:
+                try:
+                    results[symbol] = self.get_info(symbol, fields)
+                except Exception:
+                    pass
+            return results
+        return self.pool.map(lambda symbol: self.get_info(symbol, fields), symbols)
+
+    #Returns {symbol: price} for all the symbols, the ones that aren't fresh in the cache
+    #are fetched together in one batch call and only the symbols the batch couldn't
+    #find fall back to a lookup of their own. A symbol another request is already
+    #fetching (in its batch or on its own) is waited on rather than fetched again.
+    #max_age overrides the price ttl (the live poller passes 0 to always get the newest prices)
+    def get_prices(self, symbols, max_age=None):
+        prices = {}
+        missing = []
+        now = time.monotonic()
+        max_age = self.price_ttl if max_age is None else max_age
+
+        with self._lock:
+            for symbol in dict.fromkeys(symbol.upper() for symbol in symbols):
+                entry = self._entries.get(symbol)
+                if entry is not None and entry['price'] is not None and now - entry['price_at'] < max_age:
+                    self._entries.move_to_end(symbol)
+                    self.hits += 1
+                    prices[symbol] = entry['price']
+                elif entry is not None and entry['info'] is not None and now - entry['info_at'] < max_age:
+                    #Fresh info that just doesn't have a price, no point asking again
+                    self._entries.move_to_end(symbol)
+                    self.hits += 1
+                    prices[symbol] = 0
+                else:
+                    self.misses += 1
+                    missing.append(symbol)
+
+            #Either join the fetch that is already running for the symbol or lead a new one
+            waiting = {}
+            leading = {}
+            for symbol in missing:
+                inflight = self._price_inflight.get(symbol) or self._inflight.get(symbol)
+                if inflight is not None:
+                    self.shared += 1
+                    waiting[symbol] = inflight
+                else:
+                    leading[symbol] = self._price_inflight[symbol] = _InflightFetch()
+
+        gave_up = set() #Symbols upstream was too slow for, single lookups would only wait again
+        if leading:
+            try:
+                batch_prices = {}
+                if self.batch_fetcher is not None:
+                    try:
+                        if self.pool is not None:
+                            batch_prices = self.pool.call(self.batch_fetcher, list(leading))
+                        else:
+                            batch_prices = self.batch_fetcher(list(leading))
+                    except TimeoutError:
+                        gave_up.update(leading)
+                    except Exception:
+                        pass #Let the single lookups below deal with it
+                for symbol, price in batch_prices.items():
+                    symbol = symbol.upper()
+                    if price and symbol in leading:
+                        prices[symbol] = price
+                        self._store_price(symbol, price)
+                        leading[symbol].result = price
+            finally:
+                with self._lock:
+                    for symbol in leading:
+                        self._price_inflight.pop(symbol, None)
+                for inflight in leading.values():
+                    inflight.done.set()
+
+        for symbol, inflight in waiting.items():
+            if not inflight.done.wait(self._wait_timeout()):
+                gave_up.add(symbol)
+                continue
+            price = find_stock_price(inflight.result) if isinstance(inflight.result, dict) else inflight.result
+            if price:
+                prices[symbol] = price
+
+        for symbol in gave_up:
+            prices.setdefault(symbol, 0)
+        missing = [symbol for symbol in missing if symbol not in prices]
+        if missing:
+            found = self.get_many(missing)
+            for symbol in missing:
+                prices[symbol] = find_stock_price(found[symbol]) if symbol in found else 0
+        return prices
+
+    #How long to wait on a fetch someone else is running, the same as the pool would
+    def _wait_timeout(self):
+        return self.pool.timeout if self.pool is not None else None
+
+    def _entry(self, symbol):
+        entry = self._entries.get(symbol)
+        if entry is None:
+            entry = {'info': None, 'info_at': 0, 'price': None, 'price_at': 0}
+            self._entries[symbol] = entry
+        self._entries.move_to_end(symbol)
+
+        #Drop the least recently used symbols once we go over the limit
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def _store(self, symbol, info):
+        with self._lock:
+            entry = self._entry(symbol)
+            entry['info'] = info
+            entry['info_at'] = time.monotonic()
+
+            #A full info also holds the price so batch lookups can use it too
+            price = find_stock_price(info)
+            if price:
+                entry['price'] = price
+                entry['price_at'] = entry['info_at']
+
+    def _store_price(self, symbol, price):
+        with self._lock:
+            entry = self._entry(symbol)
+            entry['price'] = price
+            entry['price_at'] = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared_fetches': self.shared,
+                'evictions': self.evictions,
+                'hit_ratio': (self.hits / lookups) if lookups > 0 else 0
+            }
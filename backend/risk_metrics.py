@@ -0,0 +1,99 @@
+#Works out the risk numbers of a portfolio from the same day by day share and price
+#matrices the performance chart is built from. The daily returns and the covariance
+#of the tickers are worked out once and every metric is read off of them
+import numpy as np
+
+TRADING_DAYS = 252 #Used to turn the daily numbers into yearly ones
+
+#Daily returns of every column, a day after a missing (zero) price counts as no change
+def daily_returns(price_matrix):
+    previous = price_matrix[:-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.where(previous > 0, price_matrix[1:] / previous - 1, 0.0)
+    returns[~np.isfinite(returns)] = 0.0
+    return returns
+
+#The return of the portfolio each day, from what was held at the end of the day before.
+#Buying or selling only changes the next day's holdings, so money moving in and out
+#doesn't show up as a gain or a loss
+def portfolio_returns(shares_matrix, price_matrix):
+    start_values = np.einsum('ij,ij->i', shares_matrix[:-1], price_matrix[:-1])
+    end_values = np.einsum('ij,ij->i', shares_matrix[:-1], price_matrix[1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.where(start_values > 0, end_values / start_values - 1, 0.0)
+    held = start_values > 0
+    return returns, held
+
+#Biggest fall from a peak of the growth of 1 invested, with where it started and ended
+def max_drawdown(returns, dates):
+    wealth = np.cumprod(1 + returns)
+    peaks = np.maximum.accumulate(wealth)
+    drawdowns = wealth / peaks - 1
+    trough = int(np.argmin(drawdowns))
+    peak = int(np.argmax(wealth[:trough + 1])) if trough > 0 else 0
+    return {
+        'max_drawdown': float(drawdowns[trough]),
+        'peak_date': dates[peak],
+        'trough_date': dates[trough]
+    }
+
+#dates are the days of the rows (as strings), benchmark_prices is the close of the
+#benchmark on each of them (or None) and risk_free is the yearly risk free rate
+def calculating_risk(dates, tickers, shares_matrix, price_matrix, benchmark_prices=None, risk_free=0.0):
+    returns, held = portfolio_returns(shares_matrix, price_matrix)
+    returns = returns[held] #Days before anything was bought say nothing about the risk
+    return_dates = [date for date, was_held in zip(dates[1:], held) if was_held]
+
+    result = {
+        'observations': int(len(returns)),
+        'volatility': None,
+        'annual_return': None,
+        'sharpe': None,
+        'max_drawdown': None,
+        'peak_date': None,
+        'trough_date': None,
+        'beta': None,
+        'positions': [],
+        'covariance': {'tickers': list(tickers), 'matrix': []}
+    }
+    if len(returns) < 2:
+        return result
+
+    #The portfolio as a whole
+    volatility = float(np.std(returns, ddof=1) * np.sqrt(TRADING_DAYS))
+    annual_return = float(np.mean(returns) * TRADING_DAYS)
+    result['volatility'] = volatility
+    result['annual_return'] = annual_return
+    result['sharpe'] = (annual_return - risk_free) / volatility if volatility > 0 else None
+    result.update(max_drawdown(returns, return_dates))
+
+    if benchmark_prices is not None:
+        benchmark_returns = daily_returns(benchmark_prices.reshape(-1, 1))[:, 0][held]
+        benchmark_variance = np.var(benchmark_returns, ddof=1)
+        if benchmark_variance > 0:
+            result['beta'] = float(np.cov(returns, benchmark_returns)[0, 1] / benchmark_variance)
+
+    #The tickers, one covariance matrix is shared by the contributions and the output
+    asset_returns = daily_returns(price_matrix)[held]
+    covariance = np.cov(asset_returns, rowvar=False, ddof=1).reshape(len(tickers), len(tickers)) * TRADING_DAYS
+    values = shares_matrix[-1] * price_matrix[-1]
+    total_value = values.sum()
+    weights = values / total_value if total_value > 0 else np.zeros(len(tickers))
+
+    #How much of the portfolio's (ex-ante) volatility comes from each position,
+    #the contributions add up to the volatility itself
+    marginal = covariance @ weights
+    portfolio_volatility = float(np.sqrt(max(weights @ marginal, 0)))
+    contributions = weights * marginal / portfolio_volatility if portfolio_volatility > 0 else np.zeros(len(tickers))
+    ticker_volatility = np.sqrt(np.clip(np.diag(covariance), 0, None))
+
+    result['ex_ante_volatility'] = portfolio_volatility
+    result['positions'] = [{
+        'ticker': ticker,
+        'weight': float(weights[column] * 100),
+        'volatility': float(ticker_volatility[column]),
+        'risk_contribution': float(contributions[column]),
+        'risk_contribution_percent': float(contributions[column] / portfolio_volatility * 100) if portfolio_volatility > 0 else 0
+    } for column, ticker in enumerate(tickers)]
+    result['covariance']['matrix'] = covariance.tolist()
+    return result
@@ -0,0 +1,173 @@
+#Holds the local reference table of every symbol we have seen (name, sector, industry,
+#currency and market cap). These barely ever change, so they are saved to disk and read
+#from memory on the hot path instead of asking Yahoo for the whole .info each time. A
+#background thread keeps the saved rows from getting too old, and a symbol that isn't
+#in the table yet is looked up the first time someone asks for it
+import os
+import sqlite3
+import threading
+import time
+
+from quote_cache import METADATA_FIELDS
+
+REFERENCE_TTL = 24 * 60 * 60 #Seconds before a saved row is refreshed in the background
+REFRESH_CHECK_INTERVAL = 15 * 60 #Seconds between checks for rows that need refreshing
+REFRESH_BATCH = 200 #Most symbols refreshed in one check, so a big table is spread over several
+
+#The table columns for each of the METADATA_FIELDS
+COLUMNS = {'longName': 'long_name', 'sector': 'sector', 'industry': 'industry',
+           'marketCap': 'market_cap', 'currency': 'currency'}
+
+class SymbolReference:
+    def __init__(self, path, fetcher, pool=None, symbols_source=None,
+                 ttl=REFERENCE_TTL, check_interval=REFRESH_CHECK_INTERVAL):
+        self.path = path
+        self.fetcher = fetcher #Function that takes a symbol and returns its info dictionary
+        self.pool = pool #Optional UpstreamPool so cold symbols are looked up side by side (and given up on after its timeout)
+        self.symbols_source = symbols_source #Optional function returning the symbols that should always be in the table
+        self.ttl = ttl
+        self.check_interval = check_interval
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._thread = None
+
+        #Counters so we can see how often the hot path still has to go upstream
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS symbols (
+                symbol TEXT PRIMARY KEY, long_name TEXT, sector TEXT, industry TEXT,
+                market_cap NUMERIC, currency TEXT, updated_at REAL NOT NULL)''')
+            self._connection.commit()
+
+            #The whole table is small enough to keep in memory, so reads never touch the file
+            self._records = {}
+            columns = ', '.join(COLUMNS[field] for field in METADATA_FIELDS)
+            for row in self._connection.execute('SELECT symbol, %s, updated_at FROM symbols' % columns):
+                self._records[row[0]] = self._record(row[0], row[1:-1], row[-1])
+
+    def _record(self, symbol, values, updated_at):
+        record = {'symbol': symbol, 'updated_at': updated_at}
+        for field, value in zip(METADATA_FIELDS, values):
+            if value is not None:
+                record[field] = value
+        return record
+
+    #Returns the saved record of every symbol, the ones that aren't saved yet are
+    #looked up now (unless fill is False). Symbols that can't be found are left out
+    def get_many(self, symbols, fill=True):
+        self._starting()
+        symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+        records = {}
+        missing = []
+        with self._lock:
+            for symbol in symbols:
+                record = self._records.get(symbol)
+                if record is not None:
+                    self.hits += 1
+                    records[symbol] = record
+                else:
+                    self.misses += 1
+                    missing.append(symbol)
+
+        if missing and fill:
+            records.update(self._filling(missing))
+        return records
+
+    def get(self, symbol, fill=True):
+        return self.get_many([symbol], fill=fill).get(symbol.upper())
+
+    #Looks the symbols up upstream and saves whatever comes back
+    def _filling(self, symbols):
+        if self.pool is None:
+            infos = {}
+            for symbol in symbols:
+                try:
+                    infos[symbol] = self.fetcher(symbol)
+                except Exception:
+                    pass #Stays missing and is tried again next time
+        else:
+            infos = self.pool.map(self.fetcher, symbols)
+        return self.store_many(infos)
+
+    #Saves the metadata out of {symbol: info dictionary}, an info without any of the
+    #fields (an unknown symbol) isn't saved so it gets another chance later
+    def store_many(self, infos):
+        now = time.time()
+        records = {}
+        for symbol, info in infos.items():
+            if not info or not any(info.get(field) for field in METADATA_FIELDS):
+                continue
+            records[symbol.upper()] = self._record(symbol.upper(), [info.get(field) for field in METADATA_FIELDS], now)
+        if not records:
+            return records
+
+        rows = [(symbol,) + tuple(record.get(field) for field in METADATA_FIELDS) + (now,) for symbol, record in records.items()]
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO symbols (symbol, %s, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)'
+                                         % ', '.join(COLUMNS[field] for field in METADATA_FIELDS), rows)
+            self._connection.commit()
+            self._records.update(records)
+        return records
+
+    #The symbols that are missing from the table or haven't been refreshed in ttl
+    #seconds, oldest first and at most REFRESH_BATCH of them
+    def stale_symbols(self):
+        wanted = set(symbol.upper() for symbol in self.symbols_source()) if self.symbols_source is not None else set()
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            missing = sorted(wanted - set(self._records))
+            old = sorted((record['updated_at'], symbol) for symbol, record in self._records.items() if record['updated_at'] < cutoff)
+        return (missing + [symbol for _, symbol in old])[:REFRESH_BATCH]
+
+    def refresh(self):
+        symbols = self.stale_symbols()
+        if symbols:
+            self._filling(symbols)
+            self.refreshes += 1
+        return len(symbols)
+
+    #The refresher only starts once the table is actually used
+    def _starting(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refreshing, name='symbol-reference-refresh', daemon=True)
+                self._thread.start()
+
+    def _refreshing(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                pass #Whatever is saved keeps being used until the next check works
+            time.sleep(self.check_interval)
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM symbols')
+            self._connection.commit()
+            self._records.clear()
+
+    #Makes sure the database can still be read, raising if it can't
+    def ping(self):
+        with self._lock:
+            self._connection.execute('SELECT 1 FROM symbols LIMIT 1').fetchone()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'symbols': len(self._records),
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'hit_ratio': (self.hits / lookups) if lookups > 0 else 0
+            }
@@ -0,0 +1,5 @@
+#The backend modules are imported the same way app.py imports them, straight from backend/
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
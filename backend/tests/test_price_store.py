@@ -0,0 +1,45 @@
+#What the provider hands back decides which days count as saved
+import pandas as pd
+
+from price_store import PriceStore
+
+#Every weekday of 2023-2024 apart from New Year's Day 2024
+TRADING_DAYS = pd.bdate_range('2023-01-02', '2024-12-31').drop(pd.Timestamp('2024-01-01'))
+CLOSES = pd.DataFrame({'Close': range(len(TRADING_DAYS))}, index=TRADING_DAYS, dtype=float)
+
+def making_store(replies=None):
+    calls = []
+    def fetcher(symbol, start, end):
+        calls.append((start, end))
+        if replies:
+            return replies.pop(0)
+        return CLOSES[(CLOSES.index >= start) & (CLOSES.index < end)]
+    return PriceStore(':memory:', fetcher), calls
+
+def test_holiday_before_the_saved_range_still_joins_it():
+    store, calls = making_store()
+    store.get_history('AAA', '2024-01-02', '2024-06-01')
+    store.get_history('AAA', '2023-07-03', '2024-06-01')
+    assert store._coverage('AAA') == ('2023-07-03', '2024-06-01')
+
+    store.get_history('AAA', '2023-07-03', '2024-06-01')
+    assert len(calls) == 2
+
+def test_empty_reply_is_not_saved_and_waits_before_retrying():
+    empty = pd.DataFrame({'Close': []}, index=pd.DatetimeIndex([]))
+    store, calls = making_store([empty])
+    assert len(store.get_history('AAA', '2023-01-02', '2024-01-01')) == 0
+    assert store._coverage('AAA') is None
+
+    store.get_history('AAA', '2023-01-02', '2024-01-01')
+    assert len(calls) == 1
+
+def test_reply_cut_short_gets_the_rest_fetched():
+    first_half = CLOSES['2023-01-02':'2023-06-30']
+    store, calls = making_store([first_half])
+    store.get_history('AAA', '2023-01-02', '2024-01-01')
+    assert store._coverage('AAA') == ('2023-01-02', '2023-07-01')
+
+    store.get_history('AAA', '2023-01-02', '2024-01-01')
+    assert calls[-1] == ('2023-07-01', '2024-01-01')
+    assert store._coverage('AAA') == ('2023-01-02', '2024-01-01')
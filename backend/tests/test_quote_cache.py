@@ -0,0 +1,44 @@
+#Requests asking for the same prices at the same time share one upstream fetch
+import threading
+import time
+
+from quote_cache import QuoteCache
+
+def test_concurrent_batches_share_one_fetch():
+    calls = []
+    def batch(symbols):
+        calls.append(sorted(symbols))
+        time.sleep(0.2)
+        return {symbol: 10.0 for symbol in symbols}
+    cache = QuoteCache(lambda symbol: {'currentPrice': 5.0}, batch)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_prices(['AAPL', 'MSFT']))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [['AAPL', 'MSFT']]
+    assert results == [{'AAPL': 10.0, 'MSFT': 10.0}] * 4
+    assert cache.stats()['shared_fetches'] == 6
+
+def test_overlapping_batch_only_fetches_the_new_symbols():
+    calls = []
+    def batch(symbols):
+        calls.append(sorted(symbols))
+        time.sleep(0.2)
+        return {symbol: 10.0 for symbol in symbols}
+    cache = QuoteCache(lambda symbol: {'currentPrice': 5.0}, batch)
+
+    results = {}
+    first = threading.Thread(target=lambda: results.update(first=cache.get_prices(['AAPL', 'MSFT'])))
+    second = threading.Thread(target=lambda: results.update(second=cache.get_prices(['MSFT', 'GOOG'])))
+    first.start()
+    time.sleep(0.05)
+    second.start()
+    first.join()
+    second.join()
+
+    assert calls == [['AAPL', 'MSFT'], ['GOOG']]
+    assert results['second'] == {'MSFT': 10.0, 'GOOG': 10.0}
@@ -0,0 +1,61 @@
+#A trade only counts as added once the log has it on disk
+import pytest
+
+from transaction_log import TransactionLog
+from transaction_store import TransactionStore
+
+def trade(ticker, shares, price, day, side='buy'):
+    return {'ticker': ticker, 'shares': float(shares), 'purchase_price': float(price),
+            'purchase_date': day, 'side': side, 'portfolio_id': 'p1'}
+
+class FailingLog:
+    def append(self, records):
+        raise OSError('No space left on device')
+
+class FailingFile:
+    def __init__(self, log_file):
+        self.log_file = log_file
+
+    def write(self, data):
+        return self.log_file.write(data)
+
+    def flush(self):
+        raise OSError('Input/output error')
+
+    def fileno(self):
+        return self.log_file.fileno()
+
+    def close(self):
+        self.log_file.close()
+
+def test_trades_the_log_could_not_take_are_undone():
+    store = TransactionStore()
+    store.add('p1', trade('AAPL', 10, 100, '2024-01-02'))
+    cumulative = store.cumulative_holdings('p1')
+    store.log = FailingLog()
+
+    with pytest.raises(OSError):
+        store.add_many('p1', [trade('AAPL', 5, 110, '2023-06-01'), trade('MSFT', 3, 300, '2024-02-01'),
+                              trade('MSFT', 1, 310, '2024-02-01', 'sell')])
+    assert len(store.for_portfolio('p1')) == 1
+    assert store.tickers('p1') == ['AAPL']
+    assert store.holdings('p1')['AAPL']['shares'] == 10
+    assert store.cumulative_holdings('p1').equals(cumulative)
+
+    store.log = None
+    assert store.add('p1', trade('MSFT', 3, 300, '2024-02-01'))['id'] == 2
+
+def test_failed_flush_wakes_the_waiters(tmp_path):
+    log = TransactionLog(str(tmp_path))
+    log.recover()
+    log._file = FailingFile(log._file)
+    store = TransactionStore(log=log)
+    log.start(lambda: (store.dump_state()[0], log.generation))
+
+    with pytest.raises(RuntimeError):
+        store.add('p1', trade('AAPL', 10, 100, '2024-01-02'))
+    assert store.for_portfolio('p1') == []
+    assert log.stats()['error'] == 'Input/output error'
+    with pytest.raises(RuntimeError):
+        log.append([['transaction', trade('AAPL', 1, 100, '2024-01-02')]])
+    log.close()
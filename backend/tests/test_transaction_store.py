@@ -0,0 +1,85 @@
+#Trades are applied by their date, not by the order they are added in
+import pytest
+
+from transaction_store import TransactionStore, OversoldError
+
+def trade(ticker, shares, price, day, side='buy'):
+    return {'ticker': ticker, 'shares': float(shares), 'purchase_price': float(price),
+            'purchase_date': day, 'side': side, 'portfolio_id': 'p1'}
+
+def test_sell_dated_before_its_buy_is_rejected():
+    store = TransactionStore()
+    store.add('p1', trade('AAPL', 10, 100, '2024-06-01'))
+    with pytest.raises(OversoldError):
+        store.add('p1', trade('AAPL', 5, 100, '2023-06-01', 'sell'))
+
+    #Nothing was held in June 2023 and the holdings never went below nothing
+    cumulative = store.cumulative_holdings('p1')
+    assert (cumulative['AAPL'] >= 0).all()
+    assert store.holdings('p1')['AAPL']['shares'] == 10
+
+def test_newest_first_import_is_applied_in_date_order():
+    store = TransactionStore()
+    added, oversold = store.add_many('p1', [
+        trade('AAPL', 4, 120, '2024-03-01', 'sell'),
+        trade('AAPL', 10, 100, '2024-01-02'),
+    ])
+    assert oversold == []
+    assert len(added) == 2
+    assert store.holdings('p1')['AAPL']['shares'] == 6
+
+def test_buys_of_a_day_go_before_its_sells_in_an_import():
+    store = TransactionStore()
+    added, oversold = store.add_many('p1', [
+        trade('AAPL', 5, 110, '2024-01-02', 'sell'),
+        trade('AAPL', 5, 100, '2024-01-02'),
+    ])
+    assert oversold == []
+    assert store.holdings('p1')['AAPL']['shares'] == 0
+
+def test_fifo_sells_the_oldest_lot_by_date():
+    store = TransactionStore()
+    store.add('p1', trade('AAPL', 10, 90, '2024-06-03'))
+    store.add('p1', trade('AAPL', 10, 10, '2023-01-03'))
+    store.add('p1', trade('AAPL', 10, 100, '2024-07-01', 'sell'))
+
+    fifo = store.holdings('p1', 'fifo')['AAPL']
+    assert fifo['realized_gain'] == pytest.approx(900)
+    assert fifo['total_cost'] == pytest.approx(900)
+
+    average = store.holdings('p1', 'average')['AAPL']
+    assert average['realized_gain'] == pytest.approx(500)
+
+def test_backdated_buy_is_used_by_an_earlier_dated_sell():
+    store = TransactionStore()
+    store.add('p1', trade('AAPL', 10, 50, '2024-01-02'))
+    store.add('p1', trade('AAPL', 10, 80, '2024-03-01', 'sell'))
+    store.add('p1', trade('AAPL', 5, 20, '2023-06-01'))
+
+    #The 2023 lot is the oldest, so the March sell closed it out first
+    fifo = store.holdings('p1', 'fifo')['AAPL']
+    assert fifo['shares'] == 5
+    assert fifo['realized_gain'] == pytest.approx(5 * (80 - 20) + 5 * (80 - 50))
+
+def test_sell_that_leaves_a_later_sell_oversold_is_rejected():
+    store = TransactionStore()
+    store.add('p1', trade('AAPL', 10, 100, '2024-01-02'))
+    store.add('p1', trade('AAPL', 10, 110, '2024-03-01', 'sell'))
+
+    #10 were held in February, but then the March sell would be for more than is left
+    with pytest.raises(OversoldError):
+        store.add('p1', trade('AAPL', 5, 105, '2024-02-01', 'sell'))
+    assert store.holdings('p1')['AAPL']['shares'] == 0
+
+def test_lots_are_rebuilt_in_date_order_after_loading_a_snapshot():
+    store = TransactionStore()
+    store.add('p1', trade('AAPL', 10, 90, '2024-06-03'))
+    store.add('p1', trade('AAPL', 10, 10, '2023-01-03'))
+    store.add('p1', trade('AAPL', 10, 100, '2024-07-01', 'sell'))
+    state, _ = store.dump_state()
+
+    loaded = TransactionStore()
+    loaded.load_state(state)
+    assert loaded.holdings('p1') == store.holdings('p1')
+    assert [transaction['id'] for transaction in loaded.for_portfolio('p1')] == [1, 2, 3]
+    assert [transaction['purchase_date'] for transaction in loaded.for_ticker('p1', 'AAPL')] == ['2023-01-03', '2024-06-03', '2024-07-01']
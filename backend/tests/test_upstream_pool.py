@@ -0,0 +1,55 @@
+#Every upstream call gives up after the pool timeout, however few symbols it is for
+import threading
+import time
+
+import pandas as pd
+
+from providers import UpstreamPool
+from price_store import PriceStore
+from quote_cache import QuoteCache
+from symbol_reference import SymbolReference
+
+SLOW = 2.0
+
+def timing(function, *args):
+    started = time.monotonic()
+    result = function(*args)
+    return result, time.monotonic() - started
+
+def slow_info(symbol):
+    time.sleep(SLOW)
+    return {'symbol': symbol, 'currentPrice': 10, 'longName': symbol}
+
+def test_single_slow_batch_quote_times_out():
+    pool = UpstreamPool(max_workers=2, timeout=0.2)
+    cache = QuoteCache(slow_info, lambda symbols: slow_info(symbols[0]) and {}, pool=pool)
+    prices, took = timing(cache.get_prices, ['AAA'])
+    assert prices == {'AAA': 0}
+    assert took < 1
+
+def test_single_slow_lookup_times_out():
+    pool = UpstreamPool(max_workers=2, timeout=0.2)
+    cache = QuoteCache(slow_info, pool=pool)
+    infos, took = timing(cache.get_many, ['AAA'])
+    assert infos == {}
+    assert took < 1
+
+    reference = SymbolReference(':memory:', slow_info, pool=pool, check_interval=3600)
+    records, took = timing(reference.get_many, ['BBB'])
+    assert records == {}
+    assert took < 1
+
+def test_single_slow_history_times_out():
+    pool = UpstreamPool(max_workers=2, timeout=0.2)
+    def fetcher(symbol, start, end):
+        time.sleep(SLOW)
+        return pd.DataFrame({'Close': [1.0]}, index=pd.DatetimeIndex([start]))
+    store = PriceStore(':memory:', fetcher)
+    histories, took = timing(store.get_histories, ['AAA'], '2024-01-02', '2024-02-01', pool)
+    assert histories['AAA'].empty
+    assert took < 1
+
+def test_call_from_inside_the_pool_runs_there():
+    pool = UpstreamPool(max_workers=1, timeout=1)
+    outer = pool.call(lambda: (threading.current_thread().name, pool.call(lambda: threading.current_thread().name)))
+    assert outer[0] == outer[1]
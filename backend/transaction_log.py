@@ -0,0 +1,271 @@
+#Holds the on disk copy of the users data so nothing is lost when the server restarts.
+#Every change is appended to a log file (one JSON line each) and fsynced in batches, so
+#many requests writing at once share the same fsync. Every so often the whole state is
+#written out as a binary snapshot, so on startup only the log written after the latest
+#snapshot has to be replayed. The directory holds
+#   snapshot.bin        -> pickled state covering every log up to its generation
+#   log.00000001, ...   -> the changes, one generation per file
+#   lock                -> stops a second process from writing the same log
+import errno
+import json
+import os
+import pickle
+import threading
+
+try:
+    import fcntl
+except ImportError: #Windows, we just go without the lock file there
+    fcntl = None
+
+SNAPSHOT_MAGIC = b'STSNAP01'
+SNAPSHOT_EVERY = 100000 #Records written since the last snapshot before taking a new one
+SNAPSHOT_INTERVAL = 300 #Seconds between snapshots when there has been any change at all
+
+class TransactionLog:
+    def __init__(self, directory, snapshot_every=SNAPSHOT_EVERY, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval = snapshot_interval
+
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._pending = threading.Event()
+        self._snapshot_due = threading.Event()
+        self._closed = False
+
+        self._file = None
+        self._lock_file = None
+        self.generation = 0
+        self._written_seq = 0 #Records handed to the file so far
+        self._synced_seq = 0 #Records known to be on disk
+        self.records_since_snapshot = 0
+        self.snapshots_taken = 0
+        self.fsyncs = 0
+        self.error = None #The first write or sync that failed, after it the log takes nothing more
+
+    def _log_path(self, generation):
+        return os.path.join(self.directory, 'log.%08d' % generation)
+
+    def _log_generations(self):
+        generations = []
+        for name in os.listdir(self.directory):
+            if name.startswith('log.') and name[4:].isdigit():
+                generations.append(int(name[4:]))
+        return sorted(generations)
+
+    #Reads back what was saved, returning the snapshot state (or None) and the list of
+    #records written after it, in the order they were written. If anything goes wrong
+    #the lock is let go again so the caller can simply try again later
+    def recover(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        #Only one process is allowed to own the log at a time
+        if fcntl is not None:
+            self._lock_file = open(os.path.join(self.directory, 'lock'), 'w')
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._releasing()
+                raise RuntimeError('Transaction log in %s is already in use by another process' % self.directory)
+
+        try:
+            return self._reading_saved()
+        except Exception:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._releasing()
+            raise
+
+    def _releasing(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _reading_saved(self):
+        state = None
+        snapshot_generation = 0
+        snapshot_path = os.path.join(self.directory, 'snapshot.bin')
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, 'rb') as snapshot_file:
+                if snapshot_file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                    raise RuntimeError('Snapshot file %s is not a valid snapshot' % snapshot_path)
+                snapshot_generation, state = pickle.load(snapshot_file)
+
+        records = []
+        generations = [generation for generation in self._log_generations() if generation > snapshot_generation]
+        for generation in generations:
+            with open(self._log_path(generation), 'rb') as log_file:
+                for line in log_file:
+                    #A crash in the middle of a write can leave a half line at the very end
+                    if not line.endswith(b'\n'):
+                        break
+                    records.append(json.loads(line))
+
+        #Keep writing into the newest log (after cutting off any half written line)
+        self.generation = generations[-1] if generations else snapshot_generation + 1
+        self._open_log()
+        self.records_since_snapshot = len(records)
+        return state, records
+
+    def _open_log(self):
+        path = self._log_path(self.generation)
+        if os.path.exists(path):
+            with open(path, 'rb+') as log_file:
+                data = log_file.read()
+                if data and not data.endswith(b'\n'):
+                    log_file.truncate(data.rfind(b'\n') + 1)
+        self._file = open(path, 'ab')
+
+    #Starts the background threads, snapshot_source has to return (state, generation)
+    #where generation is the last log the state fully covers
+    def start(self, snapshot_source):
+        self.snapshot_source = snapshot_source
+        threading.Thread(target=self._flushing, name='transaction-log-flush', daemon=True).start()
+        threading.Thread(target=self._snapshotting, name='transaction-log-snapshot', daemon=True).start()
+
+    #Appends the records and returns the sequence number to wait on, nothing is
+    #forced to disk here so it is cheap to call while holding other locks
+    def append(self, records):
+        lines = b''.join(json.dumps(record, separators=(',', ':')).encode() + b'\n' for record in records)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Transaction log is closed')
+            if self.error is not None:
+                raise RuntimeError('Transaction log failed: %s' % self.error)
+            try:
+                self._file.write(lines)
+            except Exception as error:
+                self._failing(error)
+                raise
+            self._written_seq += len(records)
+            self.records_since_snapshot += len(records)
+            seq = self._written_seq
+            if self.records_since_snapshot >= self.snapshot_every:
+                self._snapshot_due.set()
+        self._pending.set()
+        return seq
+
+    #Blocks until everything up to seq has been fsynced, raising if the log failed first
+    def wait(self, seq):
+        with self._lock:
+            while self._synced_seq < seq and not self._closed and self.error is None:
+                self._synced.wait()
+            if self._synced_seq < seq:
+                raise RuntimeError('Transaction log failed: %s' % (self.error or 'closed before the write was synced'))
+
+    #Has to be called holding the lock, wakes everyone waiting so they can see the error
+    def _failing(self, error):
+        if self.error is None:
+            self.error = error
+        self._synced.notify_all()
+
+    #One fsync covers every record written since the last one, so requests that
+    #arrive while an fsync is running all get flushed together by the next one
+    def _flushing(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+            with self._lock:
+                if self._closed or self.error is not None:
+                    return
+                try:
+                    self._file.flush()
+                except Exception as error:
+                    self._failing(error)
+                    return
+                target = self._written_seq
+                descriptor = self._file.fileno()
+            try:
+                os.fsync(descriptor)
+            except OSError as error:
+                #EBADF means the log was rotated in between, which already synced everything up to target
+                if error.errno != errno.EBADF:
+                    with self._lock:
+                        self._failing(error)
+                    return
+            with self._lock:
+                self.fsyncs += 1
+                self._synced_seq = max(self._synced_seq, target)
+                self._synced.notify_all()
+
+    def _snapshotting(self):
+        while not self._closed:
+            self._snapshot_due.wait(self.snapshot_interval)
+            self._snapshot_due.clear()
+            if self._closed:
+                return
+            if self.records_since_snapshot > 0:
+                try:
+                    self.snapshot()
+                except Exception:
+                    pass #The log still has everything, we just try again next time
+
+    #Closes the current log and starts the next generation, returning the one that was closed.
+    #The caller has to hold whatever lock keeps its state from changing at the same time
+    def rotate(self):
+        with self._lock:
+            if self.error is not None:
+                raise RuntimeError('Transaction log failed: %s' % self.error)
+            try:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except Exception as error:
+                self._failing(error)
+                raise
+            self._synced_seq = self._written_seq
+            self._synced.notify_all()
+            self._file.close()
+
+            closed_generation = self.generation
+            self.generation += 1
+            self._file = open(self._log_path(self.generation), 'ab')
+            self.records_since_snapshot = 0
+            return closed_generation
+
+    #Writes out a new snapshot and deletes the logs it makes unnecessary
+    def snapshot(self):
+        state, generation = self.snapshot_source()
+
+        snapshot_path = os.path.join(self.directory, 'snapshot.bin')
+        temporary_path = snapshot_path + '.tmp'
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(SNAPSHOT_MAGIC)
+            pickle.dump((generation, state), snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, snapshot_path)
+
+        for old_generation in self._log_generations():
+            if old_generation <= generation:
+                os.remove(self._log_path(old_generation))
+        self.snapshots_taken += 1
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            #After a failed write there is nothing more that can be saved, the file is just let go
+            if self.error is None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._synced_seq = self._written_seq
+            self._closed = True
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._synced.notify_all()
+        self._pending.set()
+        self._snapshot_due.set()
+        self._releasing()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'generation': self.generation,
+                'records_since_snapshot': self.records_since_snapshot,
+                'snapshots_taken': self.snapshots_taken,
+                'fsyncs': self.fsyncs,
+                'error': str(self.error) if self.error is not None else None
+            }
@@ -0,0 +1,332 @@
+#Holds all the users transactions grouped by the portfolio they belong to (and by
+#ticker inside of each portfolio) so a request only ever touches its own portfolio.
+#The holdings of every portfolio are kept up to date as trades come in so nothing
+#has to be added up again when a summary or the performance is asked for. The trades
+#of each ticker are kept in date order, so the lots (and which ones a sell closes out)
+#follow the dates of the trades rather than the order they happened to be added in
+import threading
+from array import array
+from bisect import bisect_right, insort
+
+import pandas as pd
+
+from cost_basis import TickerLots, EPSILON
+
+#Raised when a sell is for more shares than the portfolio holds
+class OversoldError(ValueError):
+    pass
+
+def is_sell(transaction):
+    return transaction.get('side') == 'sell'
+
+#The shares the trade adds to the holdings (taken away for a sell)
+def signed_shares(transaction):
+    return -transaction['shares'] if is_sell(transaction) else transaction['shares']
+
+#Trades of a ticker are ordered by their date, the ones on the same day by when they were added
+def _trade_order(transaction):
+    return (transaction['purchase_date'], transaction['id'])
+
+#Works the lots out again from the trades of one ticker (already in date order)
+def _replaying_lots(trades):
+    lots = TickerLots()
+    for trade in trades:
+        _trading(lots, trade)
+    return lots
+
+def _trading(lots, transaction):
+    if is_sell(transaction):
+        lots.sell(transaction['shares'], transaction['purchase_price'])
+    else:
+        lots.buy(transaction['shares'], transaction['purchase_price'])
+
+#Packs a list of transactions column by column so a snapshot stays small: numbers go
+#into typed arrays and repeated strings (tickers, dates, ids) into a lookup table
+def _packing_columns(transactions):
+    keys = []
+    for transaction in transactions:
+        for key in transaction:
+            if key not in keys:
+                keys.append(key)
+
+    columns = {}
+    for key in keys:
+        values = [transaction.get(key) for transaction in transactions]
+        if all(type(value) is float for value in values):
+            columns[key] = ('float', array('d', values))
+        elif all(type(value) is int for value in values):
+            columns[key] = ('int', array('q', values))
+        elif all(type(value) is str for value in values):
+            table = {}
+            indexes = array('I', (table.setdefault(value, len(table)) for value in values))
+            columns[key] = ('text', (list(table), indexes))
+        else:
+            columns[key] = ('object', values)
+    return {'count': len(transactions), 'columns': columns}
+
+def _unpacking_columns(packed):
+    columns = {}
+    for key, (kind, data) in packed['columns'].items():
+        if kind == 'text':
+            table, indexes = data
+            columns[key] = [table[index] for index in indexes]
+        else:
+            columns[key] = list(data)
+
+    keys = list(columns)
+    rows = zip(*(columns[key] for key in keys))
+    return [{key: value for key, value in zip(keys, row) if value is not None} for row in rows]
+
+class TransactionStore:
+    def __init__(self, log=None):
+        self.log = log #Optional TransactionLog every new transaction gets written to
+        self._by_portfolio = {} #portfolio_id -> [transaction, ...] in the order they were added
+        self._by_ticker = {} #portfolio_id -> {ticker: [transaction, ...] in date order}
+        self._next_id = 1 #Unique across every portfolio and only ever goes up
+        self._lock = threading.Lock()
+
+        self._lots = {} #portfolio_id -> {ticker: TickerLots}
+        self._daily_shares = {} #portfolio_id -> {purchase_date: {ticker: shares bought (less sold) that day}}
+        self._versions = {} #portfolio_id -> number of changes, so cached results know when they are stale
+        self._cumulative = {} #portfolio_id -> (version, cumulative holdings frame)
+
+    #Records the transaction under its portfolio, giving it the next id
+    def add(self, portfolio_id, transaction):
+        added, oversold = self.add_many(portfolio_id, [transaction])
+        if oversold:
+            raise OversoldError(oversold[0][1])
+        return added[0]
+
+    #Records a group of transactions in one go, they are written to the log together
+    #and only handed back once the log has them safely on disk. The group is put in date
+    #order first (brokerage exports usually list the newest trade first), with the buys of
+    #a day ahead of its sells. A sell for more shares than are held on its date (counting
+    #the earlier trades of the group) is left out, and so is one that would leave fewer
+    #than no shares after a later sell. Those come back as (transaction, reason) in the second list
+    def add_many(self, portfolio_id, transactions):
+        seq = None
+        added = []
+        oversold = []
+        with self._lock:
+            first_id = self._next_id
+            for transaction in sorted(transactions, key=lambda transaction: (transaction['purchase_date'], is_sell(transaction))):
+                if is_sell(transaction):
+                    reason = self._checking_sell(portfolio_id, transaction)
+                    if reason is not None:
+                        oversold.append((transaction, reason))
+                        continue
+                transaction['id'] = self._next_id
+                self._next_id += 1
+                self._insert(portfolio_id, transaction)
+                added.append(transaction)
+            if self.log is not None and added:
+                try:
+                    seq = self.log.append([['transaction', transaction] for transaction in added])
+                except Exception:
+                    self._undoing(portfolio_id, added, first_id)
+                    raise
+        if seq is not None:
+            try:
+                self.log.wait(seq)
+            except Exception:
+                with self._lock:
+                    self._undoing(portfolio_id, added, first_id)
+                raise
+        return added, oversold
+
+    #Takes back trades that never made it into the log, so what is in memory still matches
+    #what will be loaded after a restart. Has to be called holding the lock
+    def _undoing(self, portfolio_id, added, first_id):
+        undone = set(id(transaction) for transaction in added)
+        kept = [transaction for transaction in self._by_portfolio[portfolio_id] if id(transaction) not in undone]
+        if kept:
+            self._by_portfolio[portfolio_id] = kept
+        else:
+            del self._by_portfolio[portfolio_id]
+
+        tickers = self._by_ticker[portfolio_id]
+        portfolio_lots = self._lots[portfolio_id]
+        days = self._daily_shares[portfolio_id]
+        for transaction in added:
+            ticker = transaction['ticker']
+            if ticker in tickers:
+                tickers[ticker] = [trade for trade in tickers[ticker] if id(trade) not in undone]
+                if tickers[ticker]:
+                    portfolio_lots[ticker] = _replaying_lots(tickers[ticker])
+                else:
+                    del tickers[ticker]
+                    del portfolio_lots[ticker]
+            day = days.get(transaction['purchase_date'], {})
+            if ticker in day:
+                day[ticker] -= signed_shares(transaction)
+                if not any(trade['purchase_date'] == transaction['purchase_date'] for trade in tickers.get(ticker, ())):
+                    del day[ticker]
+                    if not day:
+                        del days[transaction['purchase_date']]
+            del transaction['id']
+
+        #Nothing else has been given an id since, so the ids can be handed out again
+        if self._next_id == first_id + len(added):
+            self._next_id = first_id
+        self._versions[portfolio_id] = self._versions.get(portfolio_id, 0) + 1
+
+    #Why the sell can't be taken (or None). The shares held on its date have to cover it,
+    #and with it taken away the holdings can't drop below nothing after any later trade
+    def _checking_sell(self, portfolio_id, transaction):
+        ticker = transaction['ticker']
+        shares = transaction['shares']
+        day = transaction['purchase_date']
+        trades = self._by_ticker.get(portfolio_id, {}).get(ticker, [])
+
+        #It goes after every trade on or before its date, usually that is the end
+        position = bisect_right(trades, day, key=lambda trade: trade['purchase_date'])
+        if position == len(trades):
+            lots = self._lots.get(portfolio_id, {}).get(ticker)
+            held = lots.shares if lots is not None else 0.0
+        else:
+            held = sum(signed_shares(trade) for trade in trades[:position])
+        if shares > held + EPSILON:
+            return 'Cannot sell %g shares of %s on %s, only %g held then' % (shares, ticker, day, held)
+
+        remaining = held - shares
+        for trade in trades[position:]:
+            remaining += signed_shares(trade)
+            if remaining < -EPSILON:
+                return ('Cannot sell %g shares of %s on %s, the sell on %s would then be for more shares than held'
+                        % (shares, ticker, day, trade['purchase_date']))
+        return None
+
+    #Puts back a transaction read from the log, keeping the id it was given back then
+    def replay(self, transaction):
+        with self._lock:
+            self._next_id = max(self._next_id, transaction['id'] + 1)
+            self._insert(transaction['portfolio_id'], transaction)
+
+    def _insert(self, portfolio_id, transaction):
+        self._by_portfolio.setdefault(portfolio_id, []).append(transaction)
+        self._apply(portfolio_id, transaction)
+
+    #Updates the lots and the dated log with one trade, sells take shares away. A trade
+    #dated after the others of its ticker (the usual case) is just added to the lots, one
+    #dated earlier has the lots of that ticker worked out again in date order
+    def _apply(self, portfolio_id, transaction):
+        ticker = transaction['ticker']
+        trades = self._by_ticker.setdefault(portfolio_id, {}).setdefault(ticker, [])
+        portfolio_lots = self._lots.setdefault(portfolio_id, {})
+
+        if not trades or _trade_order(transaction) >= _trade_order(trades[-1]):
+            trades.append(transaction)
+            if ticker not in portfolio_lots:
+                portfolio_lots[ticker] = TickerLots()
+            _trading(portfolio_lots[ticker], transaction)
+        else:
+            insort(trades, transaction, key=_trade_order)
+            portfolio_lots[ticker] = _replaying_lots(trades)
+
+        self._adding_to_day(portfolio_id, transaction)
+        self._versions[portfolio_id] = self._versions.get(portfolio_id, 0) + 1
+
+    def _adding_to_day(self, portfolio_id, transaction):
+        day = self._daily_shares.setdefault(portfolio_id, {}).setdefault(transaction['purchase_date'], {})
+        day[transaction['ticker']] = day.get(transaction['ticker'], 0) + signed_shares(transaction)
+
+    #Copies are handed back so a request can keep using them while new trades come in
+    def for_portfolio(self, portfolio_id):
+        with self._lock:
+            return list(self._by_portfolio.get(portfolio_id, ()))
+
+    #The trades of one ticker, in date order
+    def for_ticker(self, portfolio_id, ticker):
+        with self._lock:
+            return list(self._by_ticker.get(portfolio_id, {}).get(ticker.upper(), ()))
+
+    #The current shares, the cost of them and the gain realized by sells for every ticker
+    #the portfolio has traded (including the ones that have been sold off), with the
+    #cost basis worked out by the method given (fifo or average)
+    def holdings(self, portfolio_id, method='fifo'):
+        with self._lock:
+            return {ticker: lots.position(method) for ticker, lots in self._lots.get(portfolio_id, {}).items()}
+
+    #The shares of each ticker held after every trade date (dates x tickers), it only
+    #gets rebuilt when the portfolio has changed since the last time it was asked for
+    def cumulative_holdings(self, portfolio_id):
+        with self._lock:
+            version = self._versions.get(portfolio_id, 0)
+            cached = self._cumulative.get(portfolio_id)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            daily_shares = {day: dict(shares) for day, shares in self._daily_shares.get(portfolio_id, {}).items()}
+
+        if daily_shares:
+            cumulative = pd.DataFrame.from_dict(daily_shares, orient='index')
+            cumulative.index = pd.to_datetime(cumulative.index, format='%Y-%m-%d')
+            cumulative = cumulative.sort_index().fillna(0).cumsum()
+        else:
+            cumulative = pd.DataFrame(index=pd.DatetimeIndex([]))
+
+        with self._lock:
+            self._cumulative[portfolio_id] = (version, cumulative)
+        return cumulative
+
+    #Copies everything that is needed to rebuild the store, while_locked is run before
+    #the lock is let go so the caller can line something up with this exact state
+    #(the log uses it to start a new generation). Transactions are never changed after
+    #being added so only the list has to be copied while locked, the packing into
+    #columns happens afterwards. The holdings and lots aren't saved since they are
+    #rebuilt from the transactions on load anyway
+    def dump_state(self, while_locked=None):
+        with self._lock:
+            transactions = [transaction for portfolio in self._by_portfolio.values() for transaction in portfolio]
+            state = {'next_id': self._next_id, 'versions': dict(self._versions)}
+            locked_result = while_locked() if while_locked is not None else None
+
+        state['transactions'] = _packing_columns(transactions)
+        return state, locked_result
+
+    def load_state(self, state):
+        transactions = _unpacking_columns(state['transactions'])
+        with self._lock:
+            self._by_portfolio = {}
+            self._by_ticker = {}
+            self._lots = {}
+            self._daily_shares = {}
+            self._cumulative = {}
+            #The trades are grouped first and every ticker's lots are then built in one
+            #pass over its trades in date order
+            for transaction in transactions:
+                portfolio_id = transaction['portfolio_id']
+                self._by_portfolio.setdefault(portfolio_id, []).append(transaction)
+                self._by_ticker.setdefault(portfolio_id, {}).setdefault(transaction['ticker'], []).append(transaction)
+                self._adding_to_day(portfolio_id, transaction)
+            for portfolio_id, tickers in self._by_ticker.items():
+                portfolio_lots = self._lots[portfolio_id] = {}
+                for ticker, trades in tickers.items():
+                    trades.sort(key=_trade_order)
+                    portfolio_lots[ticker] = _replaying_lots(trades)
+            self._next_id = state['next_id']
+            self._versions = state['versions']
+
+    #Forgets everything, e.g. when loading the saved data failed part way through
+    def clear(self):
+        with self._lock:
+            self._by_portfolio = {}
+            self._by_ticker = {}
+            self._lots = {}
+            self._daily_shares = {}
+            self._cumulative = {}
+
+    def version(self, portfolio_id):
+        with self._lock:
+            return self._versions.get(portfolio_id, 0)
+
+    def tickers(self, portfolio_id):
+        with self._lock:
+            return list(self._by_ticker.get(portfolio_id, {}))
+
+    def portfolio_ids(self):
+        with self._lock:
+            return list(self._by_portfolio)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(transactions) for transactions in self._by_portfolio.values())
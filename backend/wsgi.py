@@ -0,0 +1,6 @@
+#Entry point for running the backend under a production WSGI server, e.g.
+#   gunicorn -c gunicorn.conf.py wsgi:app
+from app import app, opening_saved_data
+
+#Load the saved portfolios up front instead of on the first request
+opening_saved_data()
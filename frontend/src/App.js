@@ -29,22 +29,50 @@ const PortfolioDashboard = () => {
     fetchAllData();
   }, []);
 
+  // Live prices pushed from the backend, only the positions that moved come through
+  // on each update so the weights are rescaled here against the new total
+  useEffect(() => {
+    const source = new EventSource(`${API_URL}/portfolio/${PORTFOLIO_ID}/stream`);
+
+    source.addEventListener('snapshot', (event) => {
+      const data = JSON.parse(event.data);
+      if (data.positions && data.positions.length > 0) {
+        setSummary(data);
+      }
+    });
+
+    source.addEventListener('update', (event) => {
+      const update = JSON.parse(event.data);
+      setSummary((previous) => {
+        if (!previous || !previous.positions) {
+          return previous;
+        }
+        const moved = Object.fromEntries(update.positions.map((position) => [position.ticker, position]));
+        const positions = previous.positions.map((position) => {
+          const next = moved[position.ticker] || position;
+          const weight = update.total_value > 0 ? (next.current_value / update.total_value) * 100 : 0;
+          return { ...next, weight };
+        });
+        return { ...previous, ...update, positions };
+      });
+    });
+
+    return () => source.close();
+  }, []);
+
   const fetchAllData = async () => {
     setLoading(true);
     setError(null);
     
     try {
-      const [summaryRes, performanceRes, allocationRes, transactionsRes] = await Promise.all([
-        fetch(`${API_URL}/portfolio/${PORTFOLIO_ID}/summary`),
-        fetch(`${API_URL}/portfolio/${PORTFOLIO_ID}/performance?start_date=2024-01-01`),
-        fetch(`${API_URL}/portfolio/${PORTFOLIO_ID}/allocation`),
-        fetch(`${API_URL}/portfolio/${PORTFOLIO_ID}/transactions`)
-      ]);
+      // One request builds the summary, performance, allocation and transactions together
+      const dashboardRes = await fetch(`${API_URL}/portfolio/${PORTFOLIO_ID}/dashboard?start_date=2024-01-01&max_points=500`);
+      const dashboardData = await dashboardRes.json();
 
-      const summaryData = await summaryRes.json();
-      const performanceData = await performanceRes.json();
-      const allocationData = await allocationRes.json();
-      const transactionsData = await transactionsRes.json();
+      const summaryData = dashboardData.summary;
+      const performanceData = dashboardData.performance || {};
+      const allocationData = dashboardData.allocation;
+      const transactionsData = dashboardData.transactions || {};
 
       setSummary(summaryData);
       